@@ -0,0 +1,164 @@
+# app/jobs.py
+import asyncio, json, os, socket, sqlite3, threading, time, uuid
+from collections import defaultdict
+
+ACTIVE_STATES = ("PENDING", "RUNNING")
+# sloupce přidané po prvním vydání; starší databáze je dostanou při otevření
+_ADDED_COLUMNS = {"city_key": "TEXT", "claimed_by": "TEXT", "lease_until": "REAL"}
+
+
+class JobStore:
+    """Trvalé úložiště úloh v SQLite, přežije restart aplikace."""
+
+    def __init__(self, path: str, lease_seconds: float = 120):
+        # úloha patří workeru, který ji drží pronajatou; po vypršení nájmu ji převezme jiný
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                city TEXT NOT NULL,
+                task TEXT NOT NULL DEFAULT '',
+                state TEXT NOT NULL,
+                stage TEXT,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                plan_sha256 TEXT,
+                result TEXT,
+                error TEXT,
+                city_key TEXT,
+                claimed_by TEXT,
+                lease_until REAL
+            )""")
+        existing = {r["name"] for r in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in _ADDED_COLUMNS.items():
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_city_state ON jobs(city, state)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_key_state ON jobs(city_key, state)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state_created ON jobs(state, created)")
+        self._conn.commit()
+
+    def create_or_join(self, city: str, task: str, city_key: str | None = None) -> tuple[str, bool]:
+        """Vrátí (job_id, nová_úloha). Standardní úlohy pro stejnou obec (city_key, např. kód obce)
+        se slučují do jedné; nová úloha je rovnou pronajatá tomuto workeru."""
+        city_key = city_key or city
+        with self._lock:
+            if not task:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE city_key = ? AND task = '' AND state IN (?, ?) ORDER BY created LIMIT 1",
+                    (city_key, *ACTIVE_STATES),
+                ).fetchone()
+                if row:
+                    return row["id"], False
+            job_id = str(uuid.uuid4())
+            now = time.time()
+            self._conn.execute(
+                "INSERT INTO jobs (id, city, task, state, created, city_key, claimed_by, lease_until) "
+                "VALUES (?, ?, ?, 'PENDING', ?, ?, ?, ?)",
+                (job_id, city, task, now, city_key, self.worker_id, now + self.lease_seconds),
+            )
+            self._conn.commit()
+            return job_id, True
+
+    def update(self, job_id: str, **fields) -> None:
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            self._conn.commit()
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            job["result"] = json.loads(job["result"]) if job["result"] else {}
+            job["queue_depth"] = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'PENDING'"
+            ).fetchone()[0]
+            if job["state"] == "PENDING":
+                job["queue_position"] = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE state = 'PENDING' AND created < ?", (job["created"],)
+                ).fetchone()[0] + 1
+        job["wait_seconds"] = round((job["started"] or time.time()) - job["created"], 1)
+        return job
+
+    def last_success(self, city_key: str) -> dict | None:
+        with self._lock:
+            # úlohy ze starší databáze nemají city_key, u nich platí zapsaný název
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE COALESCE(city_key, city) = ? AND task = '' AND state = 'SUCCESS' "
+                "AND plan_sha256 IS NOT NULL ORDER BY finished DESC LIMIT 1",
+                (city_key,),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def requeue_unfinished(self) -> list[tuple[str, str, str, str]]:
+        """Převezme nedokončené úlohy bez platného nájmu (přerušené restartem nebo pádem workeru),
+        vrátí je do fronty a vydá (id, obec, úkol, klíč obce) k novému spuštění.
+        Převzetí je jediný UPDATE, takže stejnou úlohu nezíská víc workerů najednou."""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "UPDATE jobs SET state = 'PENDING', stage = NULL, started = NULL, claimed_by = ?, lease_until = ? "
+                "WHERE state IN (?, ?) AND (lease_until IS NULL OR lease_until < ?) "
+                "RETURNING id, city, task, city_key, created",
+                (self.worker_id, now + self.lease_seconds, *ACTIVE_STATES, now),
+            ).fetchall()
+            self._conn.commit()
+        rows = sorted(rows, key=lambda r: r["created"])
+        return [(r["id"], r["city"], r["task"], r["city_key"] or r["city"]) for r in rows]
+
+    def renew_leases(self) -> None:
+        """Prodlouží nájem všech rozpracovaných úloh tohoto workeru."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE claimed_by = ? AND state IN (?, ?)",
+                (time.time() + self.lease_seconds, self.worker_id, *ACTIVE_STATES),
+            )
+            self._conn.commit()
+
+
+class JobEvents:
+    """Rozesílá změny úloh odběratelům (SSE) přímo z pracovních vláken, bez dotazování databáze."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: defaultdict[str, set] = defaultdict(set)
+        self._progress: dict[str, dict] = {}
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        """Volá se z event loopu; události pro úlohu pak chodí do vrácené fronty."""
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers[job_id].add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(job_id, set())
+            subscribers.difference_update({s for s in subscribers if s[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(job_id, None)
+
+    def publish(self, job_id: str, event: str, data: dict) -> None:
+        with self._lock:
+            if event == "progress":
+                self._progress[job_id] = data
+            elif event == "status" and data.get("state") not in ACTIVE_STATES:
+                self._progress.pop(job_id, None)
+            subscribers = list(self._subscribers.get(job_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+
+    def progress(self, job_id: str) -> dict | None:
+        with self._lock:
+            return self._progress.get(job_id)
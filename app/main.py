@@ -1,12 +1,19 @@
 # app/main.py
-import os, uuid, concurrent.futures
+import os, re, threading, time, asyncio, concurrent.futures, unicodedata
+from collections import defaultdict
 from pathlib import Path
+from urllib.parse import quote
 
-from fastapi import FastAPI, Form
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, RedirectResponse
+from fastapi import FastAPI, Form, Request
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 
-from langchain_agent import run_langchain_agent
+from scripts.pipeline import run_stages, StageFailed, PIPELINE_STAGES
+from scripts.blob_store import file_sha256
+from scripts.packager import list_members, members_etag, zip_etag, stream_zip, STREAM_BLOCK_SIZE
+from scripts.metrics import METRICS
+from scripts.municipality_index import AmbiguousMunicipality, get_index
+from app.jobs import JobStore, JobEvents
 
 load_dotenv()
 os.environ["DISABLE_EMAIL"] = "1"
@@ -29,8 +36,15 @@ if GOOGLE_CRED_JSON:
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GOOGLE_CREDENTIALS_PATH
 
 app = FastAPI()
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
-JOBS: dict[str, dict] = {}
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=JOB_WORKERS)
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 120))
+JOBS = JobStore(os.getenv("JOBS_DB", "jobs.sqlite"), lease_seconds=JOB_LEASE_SECONDS)
+EVENTS = JobEvents()
+SSE_KEEPALIVE_SECONDS = 15
+DATA_DIR = Path("municipalities_data")
+# úlohy se stejnou obcí (podle kódu obce) nesmí současně zapisovat do municipalities_data/<obec>
+CITY_LOCKS: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
 
 HTML_FORM = """
 <!doctype html><meta charset="utf-8"><title>Analýza územního plánu</title>
@@ -60,43 +74,178 @@ button{cursor:pointer;background:#111;color:#fff;border-color:#111;margin-top:16
 def form():
     return HTML_FORM
 
-def _do_work(job_id: str, city: str, task: str):
+def _run_agent(city: str, task: str):
+    from langchain_agent import run_langchain_agent
+    instruction = (
+        f"Proveď kompletní pipeline pro obec '{city}'. "
+        f"Po dokončení ZASTAV se u kroku e-mailu (je vypnutý). "
+        f"Postup: stáhni PDF, analyzuj 5 problémů a 5 trendů, "
+        f"vytvoř shrnutí (.txt), aktualizuj BigQuery, zazipuj výstupy. "
+        f"Doplňující požadavky: {task}"
+    )
+    run_langchain_agent(instruction)
+
+def _update_job(job_id: str, **fields):
+    JOBS.update(job_id, **fields)
+    EVENTS.publish(job_id, "status", job_status(job_id))
+
+def _progress_reporter(job_id: str):
+    started = {}
+
+    def on_progress(stage: str, done: int, total: int | None):
+        start = started.setdefault(stage, time.perf_counter())
+        elapsed = time.perf_counter() - start
+        # odhad podle dosavadního tempa kroku
+        eta = round(elapsed / done * (total - done), 1) if total and done else None
+        EVENTS.publish(job_id, "progress", {"stage": stage, "done": done, "total": total, "eta_seconds": eta})
+
+    return on_progress
+
+def _run_pipeline(job_id: str, city: str, city_key: str) -> dict:
+    key = os.getenv("OPENAI_API_KEY")
+    on_stage = lambda stage: _update_job(job_id, stage=stage)
+    on_progress = _progress_reporter(job_id)
+    # nejednoznačný název skončí chybou se seznamem obcí, ze kterých lze vybrat
+    municipality = get_index().resolve(city)
+    if municipality is None:
+        raise ValueError(f'Obec "{city}" nebyla nalezena.')
+    # složka i ZIP podle názvu z tabulky obcí, ať byl zapsán s diakritikou, nebo bez
+    city = municipality["obec"]
+
+    timings = run_stages(city, key, on_stage=on_stage, stages=["download"])
+    plan_sha256 = file_sha256(Path("municipalities_data") / city / "plan.pdf")
+    JOBS.update(job_id, plan_sha256=plan_sha256)
+
+    previous = JOBS.last_success(city_key)
+    zip_path = Path("municipalities_data") / f"{city}.zip"
+    if previous and previous["plan_sha256"] == plan_sha256 and zip_path.exists():
+        # plán se od posledního úspěšného běhu nezměnil, stačí existující ZIP
+        return {"city": city, "timings": timings, "reused": True}
+
+    rest = [stage for stage, _ in PIPELINE_STAGES if stage != "download"]
+    timings.update(run_stages(city, key, on_stage=on_stage, stages=rest, on_progress=on_progress))
+    return {"city": city, "timings": timings, "reused": False}
+
+def _city_key(city: str) -> str:
+    # "Příbram" i "pribram" jsou stejná obec; nenalezený nebo nejednoznačný název skončí chybou až v úloze
     try:
-        JOBS[job_id] = {"state": "RUNNING"}
-        instruction = (
-            f"Proveď kompletní pipeline pro obec '{city}'. "
-            f"Po dokončení ZASTAV se u kroku e-mailu (je vypnutý). "
-            f"Postup: stáhni PDF, analyzuj 5 problémů a 5 trendů, "
-            f"vytvoř shrnutí (.txt), aktualizuj BigQuery, zazipuj výstupy. "
-            + (f"Doplňující požadavky: {task}" if task else "")
-        )
-        run_langchain_agent(instruction)
-
-        JOBS[job_id] = {
-            "state": "SUCCESS",
-            "data": {"city": city, "download_url": f"/download/{city}"},
-        }
-    except Exception as e:
-        JOBS[job_id] = {"state": "ERROR", "error": str(e)}
+        municipality = get_index().resolve(city)
+    except AmbiguousMunicipality:
+        municipality = None
+    return str(municipality["municipality_kod"]) if municipality else city
+
+def _do_work(job_id: str, city: str, task: str, city_key: str):
+    with CITY_LOCKS[city_key]:
+        _update_job(job_id, state="RUNNING", started=time.time())
+        try:
+            if task:
+                _run_agent(city, task)
+                result = {"timings": {}}
+            else:
+                result = _run_pipeline(job_id, city, city_key)
+            folder = result.setdefault("city", city)
+            result["download_url"] = f"/download/{folder}"
+            _update_job(job_id, state="SUCCESS", stage=None, finished=time.time(), result=result)
+        except StageFailed as e:
+            _update_job(job_id, state="ERROR", stage=e.stage, finished=time.time(),
+                        error=str(e), result={"timings": e.timings})
+        except Exception as e:
+            _update_job(job_id, state="ERROR", finished=time.time(), error=str(e))
+
+def _requeue_jobs():
+    for job_id, city, task, city_key in JOBS.requeue_unfinished():
+        executor.submit(_do_work, job_id, city, task, city_key)
+
+def _keep_leases():
+    while True:
+        time.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            JOBS.renew_leases()
+            # úlohy workeru, který mezitím spadl, převezme některý z běžících
+            _requeue_jobs()
+        except Exception as e:
+            print("Obnovení nájmu úloh selhalo:", e)
+
+@app.on_event("startup")
+def start_job_workers():
+    # až při startu, ne při importu: každý uvicorn worker si převezme jen úlohy, které ještě nikdo nedrží
+    _requeue_jobs()
+    threading.Thread(target=_keep_leases, daemon=True).start()
 
 @app.post("/jobs")
 def create_job(city: str = Form(...), task: str = Form("")):
-    job_id = str(uuid.uuid4())
-    JOBS[job_id] = {"state": "PENDING"}
-    executor.submit(_do_work, job_id, city.strip(), task.strip())
+    city, task = city.strip(), task.strip()
+    city_key = _city_key(city)
+    job_id, created = JOBS.create_or_join(city, task, city_key)
+    if created:
+        executor.submit(_do_work, job_id, city, task, city_key)
     return RedirectResponse(url=f"/status/{job_id}", status_code=303)
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(METRICS.render_prometheus(), media_type="text/plain; version=0.0.4")
+
 @app.get("/jobs/{job_id}")
 def job_status(job_id: str):
-    info = JOBS.get(job_id)
-    if not info:
+    job = JOBS.get(job_id)
+    if not job:
         return JSONResponse({"error": "Unknown job_id"}, status_code=404)
-    if info.get("state") == "SUCCESS":
+    info = {
+        "state": job["state"],
+        "mode": "agent" if job["task"] else "pipeline",
+        "stage": job["stage"],
+        "queue_depth": job["queue_depth"],
+        "wait_seconds": job["wait_seconds"],
+    }
+    if "queue_position" in job:
+        info["queue_position"] = job["queue_position"]
+    progress = EVENTS.progress(job_id)
+    if progress and progress["stage"] == job["stage"]:
+        info["progress"] = progress
+    if "timings" in job["result"]:
+        info["timings"] = job["result"]["timings"]
+    if job["state"] == "ERROR":
+        info["error"] = job["error"]
+    if job["state"] == "SUCCESS":
+        info["data"] = {k: job["result"][k] for k in ("city", "download_url") if k in job["result"]}
+        info["reused"] = job["result"].get("reused", False)
         city = info["data"]["city"]
         dl = info["data"]["download_url"]
         info["download_html"] = f'<a class="button" href="{dl}">⬇️ Stáhnout ZIP ({city})</a>'
     return info
 
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    if not JOBS.get(job_id):
+        return JSONResponse({"error": "Unknown job_id"}, status_code=404)
+
+    async def stream():
+        # odběr před prvním snímkem, aby se mezi nimi neztratila žádná změna
+        queue = EVENTS.subscribe(job_id)
+        try:
+            info = await asyncio.to_thread(job_status, job_id)
+            yield _sse("status", info)
+            if "progress" in info:
+                yield _sse("progress", info["progress"])
+            state = info["state"]
+            while state in ("PENDING", "RUNNING"):
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _sse(event, data)
+                if event == "status":
+                    state = data["state"]
+        finally:
+            EVENTS.unsubscribe(job_id, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/status/{job_id}", response_class=HTMLResponse)
 def status_page(job_id: str):
     return f"""
@@ -119,37 +268,131 @@ pre{{white-space:pre-wrap;background:#f9fafb;padding:8px;border-radius:8px}}
 const statusUrl = "/jobs/{job_id}";
 const statusEl = document.getElementById("status");
 const resultEl = document.getElementById("result");
+function render(j){{
+  if (j.state === "SUCCESS") {{
+    statusEl.textContent = "Hotovo ✅";
+    const link = j.download_url || (j.data && j.data.download_url);
+    if (link) {{
+      resultEl.innerHTML = `<a class="button" href="${{link}}">⬇️ Stáhnout ZIP</a>`;
+    }} else {{
+      resultEl.innerHTML = "<pre>" + JSON.stringify(j, null, 2) + "</pre>";
+    }}
+  }} else if (j.state === "ERROR") {{
+    statusEl.textContent = "Chyba ❌";
+    resultEl.innerHTML = "<pre>" + (j.error || JSON.stringify(j, null, 2)) + "</pre>";
+  }} else {{
+    statusEl.textContent = j.stage ? `${{j.state}} – ${{j.stage}}` : (j.state || "Čekám…");
+    if (j.progress) renderProgress(j.progress);
+  }}
+  return j.state === "SUCCESS" || j.state === "ERROR";
+}}
+function renderProgress(p){{
+  const count = p.total ? `${{p.done}}/${{p.total}}` : `${{p.done}}`;
+  const eta = p.eta_seconds != null ? ` (zbývá ~${{Math.ceil(p.eta_seconds)}} s)` : "";
+  statusEl.textContent = `RUNNING – ${{p.stage}}: část ${{count}} zpracována${{eta}}`;
+}}
 async function poll(){{
   try {{
     const r = await fetch(statusUrl);
-    const j = await r.json();
-    if (j.state === "SUCCESS") {{
-      statusEl.textContent = "Hotovo ✅";
-      const link = j.download_url || (j.data && j.data.download_url);
-      if (link) {{
-        resultEl.innerHTML = `<a class="button" href="${{link}}">⬇️ Stáhnout ZIP</a>`;
-      }} else {{
-        resultEl.innerHTML = "<pre>" + JSON.stringify(j, null, 2) + "</pre>";
-      }}
-    }} else if (j.state === "ERROR") {{
-      statusEl.textContent = "Chyba ❌";
-      resultEl.innerHTML = "<pre>" + (j.error || JSON.stringify(j, null, 2)) + "</pre>";
-    }} else {{
-      statusEl.textContent = j.state || "Čekám…";
-      setTimeout(poll, 1200);
-    }}
+    if (!render(await r.json())) setTimeout(poll, 1200);
   }} catch (e) {{
     statusEl.textContent = "Chyba při načítání stavu";
     resultEl.textContent = String(e);
   }}
 }}
-poll();
+if (window.EventSource) {{
+  // změny posílá server sám; dotazování zůstává jen pro prohlížeče bez SSE
+  const events = new EventSource(statusUrl + "/events");
+  events.addEventListener("status", e => {{ if (render(JSON.parse(e.data))) events.close(); }});
+  events.addEventListener("progress", e => renderProgress(JSON.parse(e.data)));
+}} else {{
+  poll();
+}}
 </script>
 """
 
+def _iter_file_range(path: Path, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(STREAM_BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+def _parse_range(header: str, size: int):
+    # podporujeme jeden rozsah, "bytes=start-end" nebo "bytes=-suffix"; neplatná hlavička
+    # se podle RFC 9110 ignoruje (None), jen nesplnitelný rozsah je chyba 416
+    match = RANGE_PATTERN.fullmatch(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last), size - 1) if last else size - 1
+    elif int(last) == 0:
+        raise ValueError(header)
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size:
+        raise ValueError(header)
+    return start, end
+
+def _city_folder(city: str) -> Path | None:
+    # název obce je jediná složka přímo v DATA_DIR, nikdy cesta ven z ní
+    if not city or city in (".", "..") or any(c in city for c in ("/", "\\", "\0")):
+        return None
+    base = DATA_DIR.resolve()
+    folder = (DATA_DIR / city).resolve()
+    return folder if folder.parent == base else None
+
+def _content_disposition(filename: str) -> str:
+    # hlavičky jsou latin-1; diakritika jde přes filename* (RFC 6266) a ASCII náhradu
+    quoted = quote(filename)
+    if quoted == filename:
+        return f'attachment; filename="{filename}"'
+    fallback = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode().replace('"', "")
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{quoted}'
+
 @app.get("/download/{city}")
-def download_zip(city: str):
-    p = Path("municipalities_data") / f"{city}.zip"
-    if p.exists():
-        return FileResponse(p, filename=p.name)
-    return {"error": f"ZIP not found at {p}"}
+def download_zip(city: str, request: Request):
+    folder = _city_folder(city)
+    if folder is None:
+        return JSONResponse({"error": "Invalid city"}, status_code=400)
+    p = folder.with_name(f"{folder.name}.zip")
+    if not folder.is_dir() and not p.exists():
+        return JSONResponse({"error": f"ZIP not found for {city}"}, status_code=404)
+
+    etag = members_etag(list_members(folder)) if folder.is_dir() else zip_etag(p)
+    # ZIP streamovaný ze složky má stejný obsah, ale jiné bajty než archiv z build_zip,
+    # proto jen slabý ETag, který If-Range nikdy nesplní
+    streamed = zip_etag(p) != etag
+    headers = {"ETag": f'W/"{etag}"' if streamed else f'"{etag}"', "Content-Disposition": _content_disposition(p.name)}
+    if request.headers.get("if-none-match", "").strip() in (f'"{etag}"', f'W/"{etag}"', "*"):
+        return Response(status_code=304, headers={"ETag": headers["ETag"]})
+
+    if streamed:
+        # archiv chybí nebo je zastaralý: streamujeme rovnou ze složky, bez čekání na zabalení
+        return StreamingResponse(stream_zip(folder.name, str(DATA_DIR)), media_type="application/zip", headers=headers)
+
+    size = p.stat().st_size
+    headers["Accept-Ranges"] = "bytes"
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == headers["ETag"]):
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}", **headers})
+        if byte_range:
+            start, end = byte_range
+            headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)})
+            return StreamingResponse(_iter_file_range(p, start, end - start + 1), status_code=206,
+                                     media_type="application/zip", headers=headers)
+    headers["Content-Length"] = str(size)
+    return StreamingResponse(_iter_file_range(p, 0, size), media_type="application/zip", headers=headers)
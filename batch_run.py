@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import threading
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from scripts.downloader import download_plan
+from scripts.summarizer import analyze_issues_and_trends, generate_summary_txt
+from scripts.bigquery_updater import BigQueryUpserter, load_enriched
+from scripts.llm_cache import LLM_CACHE
+from scripts.metrics import METRICS
+from scripts.municipality_index import get_index, normalize_name
+from scripts.plan_events import PLAN_EVENTS
+
+
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+STATE_PATH = 'batch_state.json'
+SCHEDULE_PATH = 'batch_schedule.json'
+
+# krok vrací DEFERRED, pokud se o výsledku rozhodne později (dávkový zápis do BigQuery)
+DEFERRED = object()
+UPSERTER: BigQueryUpserter | None = None
+
+def queue_upload(city: str):
+    df = load_enriched(city)
+    if df is None:
+        return False
+    UPSERTER.add(df, key=city)
+    return DEFERRED
+
+STAGES = {
+    'download': lambda city: bool(download_plan(city)),
+    'analyze': lambda city: analyze_issues_and_trends(city, OPENAI_API_KEY),
+    'summary': lambda city: generate_summary_txt(city, OPENAI_API_KEY),
+    'upload': queue_upload,
+}
+DEFAULT_WORKERS = {'download': 4, 'analyze': 2, 'summary': 2, 'upload': 2}
+
+def select_cities(cities, kraj=None, okres=None) -> list[str]:
+    index = get_index()
+    if cities and cities != ['all']:
+        rows = []
+        for city in cities:
+            row = index.by_kod(city) if city.isdigit() else None
+            rows.extend([row] if row else index.by_name(city, kraj, okres))
+    else:
+        rows = [r for r in index.rows()
+                if (not kraj or r['kraj'] == kraj) and (not okres or str(r['okres_kod']) == str(okres))]
+
+    return _city_ids(rows, index)
+
+def _city_ids(rows, index) -> list[str]:
+    # obce se stejným názvem se zpracovávají pod svým kódem, aby se nepletly jejich složky
+    name_counts = Counter(normalize_name(r['obec']) for r in index.rows())
+    selected = [r['obec'] if name_counts[normalize_name(r['obec'])] == 1 else str(r['municipality_kod'])
+                for r in rows]
+    return list(dict.fromkeys(selected))
+
+def changed_cities(since: str, kraj=None, okres=None) -> list[str]:
+    '''Obce, jejichž územní plán byl podle exportu ÚÚR od data since vydán nebo nabyl účinnosti.'''
+    index = get_index()
+    changed = PLAN_EVENTS.changed_since(since)
+    rows = [index.by_kod(kod) for kod in changed['municipality_kod'].dropna()]
+    rows = [r for r in rows if r
+            and (not kraj or r['kraj'] == kraj) and (not okres or str(r['okres_kod']) == str(okres))]
+    return _city_ids(rows, index)
+
+def read_last_run(path=SCHEDULE_PATH) -> str | None:
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('last_run')
+
+def write_last_run(day: str, path=SCHEDULE_PATH) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'last_run': day}, f)
+
+class BatchState:
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.cities = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.cities = json.load(f)
+
+    def done(self, city: str) -> list[str]:
+        with self._lock:
+            return list(self.cities.get(city, {}).get('done', []))
+
+    def record(self, city: str, stage: str, ok: bool, seconds: float) -> None:
+        with self._lock:
+            entry = self.cities.setdefault(city, {'done': [], 'timings': {}})
+            entry['timings'][stage] = round(seconds, 3)
+            if ok:
+                entry['done'].append(stage)
+                entry.pop('failed', None)
+            else:
+                entry['failed'] = stage
+            self._save()
+
+    def reset(self, cities) -> None:
+        with self._lock:
+            for city in cities:
+                self.cities.pop(city, None)
+            self._save()
+
+    def unfinished(self) -> list[str]:
+        with self._lock:
+            return [city for city, entry in self.cities.items() if 'failed' in entry]
+
+    def _save(self):
+        # zápis přes dočasný soubor, aby pád uprostřed nepoškodil checkpoint
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.cities, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+class BatchRunner:
+    def __init__(self, state: BatchState, workers: dict[str, int]):
+        self.state = state
+        self.pools = {stage: ThreadPoolExecutor(max_workers=workers[stage], thread_name_prefix=stage)
+                      for stage in STAGES}
+        self.order = list(STAGES)
+        self.stats = {stage: {'ok': 0, 'failed': 0, 'seconds': 0.0} for stage in STAGES}
+        self._remaining = 0
+        self._deferred = {}
+        self._flushed = {}
+        self._error = None
+        self._finished = threading.Condition()
+
+    def _submit_next(self, city: str):
+        done = set(self.state.done(city))
+        pending = [stage for stage in self.order if stage not in done]
+        if not pending:
+            with self._finished:
+                self._remaining -= 1
+                self._finished.notify_all()
+            return
+        stage = pending[0]
+        self.pools[stage].submit(self._run_stage, city, stage)
+
+    def _run_stage(self, city: str, stage: str):
+        start = time.perf_counter()
+        try:
+            ok = STAGES[stage](city)
+        except Exception as e:
+            print(f'Krok {stage} pro obec {city} selhal: {e}')
+            ok = False
+        seconds = time.perf_counter() - start
+        if ok is DEFERRED:
+            with self._finished:
+                # dávka mohla být odeslána ještě předtím, než se sem krok vrátil
+                if city not in self._flushed:
+                    self._deferred[city] = (stage, start)
+                    self._finished.notify_all()
+                    return
+                ok = self._flushed.pop(city)
+        self._complete(city, stage, bool(ok), seconds)
+
+    def _complete(self, city: str, stage: str, ok: bool, seconds: float):
+        finished = not ok
+        try:
+            self.state.record(city, stage, ok, seconds)
+            with self._finished:
+                self.stats[stage]['ok' if ok else 'failed'] += 1
+                self.stats[stage]['seconds'] += seconds
+            if ok:
+                self._submit_next(city)
+        except Exception as e:
+            # běží ve vlákně poolu nebo dávky; chybu převezme run(), obec se tu jen uzavře
+            finished = True
+            with self._finished:
+                self._error = self._error or e
+        finally:
+            if finished:
+                with self._finished:
+                    self._remaining -= 1
+                    self._finished.notify_all()
+
+    def on_flush(self, cities: list[str], ok: bool):
+        # řádky jsou v BigQuery až po dávkovém MERGE, teprve pak se krok zapíše do checkpointu
+        for city in cities:
+            with self._finished:
+                if city not in self._deferred:
+                    self._flushed[city] = ok
+                    continue
+                stage, start = self._deferred.pop(city)
+            self._complete(city, stage, ok, time.perf_counter() - start)
+
+    def run(self, cities: list[str], upserter=None) -> dict:
+        start = time.perf_counter()
+        self._remaining = len(cities)
+        for city in cities:
+            self._submit_next(city)
+        with self._finished:
+            # když zbývají jen obce čekající na dávku, žádná další nepřibude a dávku lze odeslat
+            self._finished.wait_for(lambda: self._remaining == len(self._deferred))
+        if upserter is not None:
+            upserter.close()
+        with self._finished:
+            self._finished.wait_for(lambda: self._remaining == 0)
+        for pool in self.pools.values():
+            pool.shutdown()
+        if self._error is not None:
+            raise self._error
+        return self.report(cities, time.perf_counter() - start)
+
+    def report(self, cities: list[str], elapsed: float) -> dict:
+        completed = sum(1 for c in cities if len(self.state.done(c)) == len(self.order))
+        stages = {}
+        for stage, s in self.stats.items():
+            runs = s['ok'] + s['failed']
+            stages[stage] = {**s, 'avg_seconds': s['seconds'] / runs if runs else 0.0}
+        return {
+            'cities': len(cities),
+            'completed': completed,
+            'elapsed_seconds': elapsed,
+            'cities_per_hour': completed / elapsed * 3600 if elapsed else 0.0,
+            'stages': stages,
+            'llm_cache': LLM_CACHE.stats(),
+            'metrics': METRICS.summary(),
+        }
+
+def print_report(report: dict) -> None:
+    print(f"\nDokončeno {report['completed']}/{report['cities']} obcí za {report['elapsed_seconds']:.1f} s "
+          f"({report['cities_per_hour']:.1f} obcí/h)")
+    for stage, s in report['stages'].items():
+        print(f"  {stage:<10} ok={s['ok']:<5} chyby={s['failed']:<5} průměr={s['avg_seconds']:.2f} s")
+    print(f"  LLM cache: {report['llm_cache']}")
+    print(json.dumps(report['metrics'], ensure_ascii=False, indent=1))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Hromadné zpracování územních plánů s obnovitelným checkpointem.')
+    parser.add_argument('cities', nargs='*', default=['all'], help='Názvy obcí nebo "all"')
+    parser.add_argument('--kraj', help='Např. jihocesky')
+    parser.add_argument('--okres', help='Kód okresu (okres_kod)')
+    parser.add_argument('--state', default=STATE_PATH, help='Soubor s checkpointem')
+    parser.add_argument('--reset', action='store_true', help='Začít znovu a ignorovat checkpoint')
+    parser.add_argument('--changed-since', metavar='YYYY-MM-DD|last',
+                        help='Plánovaný běh: jen obce se změnou plánu od data, "last" = od minulého plánovaného běhu')
+    for stage, default in DEFAULT_WORKERS.items():
+        parser.add_argument(f'--{stage}-workers', type=int, default=default)
+    args = parser.parse_args(argv)
+
+    if args.reset and os.path.exists(args.state):
+        os.remove(args.state)
+
+    global UPSERTER
+    state = BatchState(args.state)
+    started = datetime.date.today().isoformat()
+    if args.changed_since:
+        since = read_last_run() if args.changed_since == 'last' else args.changed_since
+        if since is None:
+            return print('Minulý plánovaný běh není zaznamenán, zadejte datum pro --changed-since.')
+        changed = changed_cities(since, args.kraj, args.okres)
+        # změněné obce se zpracují celé znovu, nedokončené z minula se dokončí
+        state.reset(changed)
+        cities = list(dict.fromkeys(changed + state.unfinished()))
+        print(f'Změna plánu od {since}: {len(changed)} obcí, k dokončení z minula {len(cities) - len(changed)}')
+    else:
+        cities = select_cities(args.cities, args.kraj, args.okres)
+    if not cities:
+        if args.changed_since:
+            write_last_run(started)
+        return print('Výběru neodpovídá žádná obec.')
+
+    workers = {stage: getattr(args, f'{stage}_workers') for stage in STAGES}
+    runner = BatchRunner(state, workers)
+    UPSERTER = BigQueryUpserter(on_flush=runner.on_flush)
+    print(f'Hromadné zpracování spuštěno pro {len(cities)} obcí')
+    print_report(runner.run(cities, UPSERTER))
+    if args.changed_since:
+        write_last_run(started)
+
+if __name__ == '__main__':
+    main()
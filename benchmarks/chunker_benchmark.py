@@ -0,0 +1,52 @@
+import os
+import time
+from scripts.plan_text import ENCODER, CHUNK_TOKEN_LIMIT, extract_pages, split_pages_into_chunks
+
+SAMPLES_DIR = 'municipalities_data'
+
+def legacy_split_text_into_chunks(text, max_tokens=CHUNK_TOKEN_LIMIT):
+    # původní implementace kóduje každé slovo zvlášť
+    words = text.split()
+    chunks, chunk, tokens = [], [], 0
+    for word in words:
+        t = len(ENCODER.encode(word))
+        if tokens + t > max_tokens:
+            chunks.append(' '.join(chunk))
+            chunk, tokens = [word], t
+        else:
+            chunk.append(word)
+            tokens += t
+    if chunk:
+        chunks.append(' '.join(chunk))
+    return chunks
+
+def timed(fn, *args, repeat=3):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def max_real_tokens(chunks):
+    return max((len(ENCODER.encode(c)) for c in chunks), default=0)
+
+def run(samples_dir=SAMPLES_DIR, max_tokens=CHUNK_TOKEN_LIMIT):
+    print(f'{"obec":<24}{"stran":>6}{"původní s":>11}{"nový s":>9}{"zrychlení":>11}{"částí":>12}{"max tokenů":>14}')
+    for city in sorted(os.listdir(samples_dir)):
+        pdf_path = os.path.join(samples_dir, city, 'plan.pdf')
+        if not os.path.exists(pdf_path):
+            continue
+        pages = extract_pages(pdf_path)
+        text = '\n'.join(pages)
+
+        legacy_time, legacy_chunks = timed(legacy_split_text_into_chunks, text, max_tokens)
+        new_time, new_chunks = timed(split_pages_into_chunks, pages, max_tokens)
+
+        speedup = legacy_time / new_time if new_time else float('inf')
+        print(f'{city:<24}{len(pages):>6}{legacy_time:>11.3f}{new_time:>9.3f}{speedup:>10.1f}x'
+              f'{len(legacy_chunks):>6}/{len(new_chunks):<5}'
+              f'{max_real_tokens(legacy_chunks):>7}/{max_real_tokens(new_chunks):<6}')
+
+if __name__ == '__main__':
+    run()
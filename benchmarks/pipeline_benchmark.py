@@ -0,0 +1,156 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import smtplib
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import ExitStack, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+# benchmark nemá používat uložené odpovědi LLM, jinak by měřil jen cache
+os.environ['LLM_CACHE_DISABLE'] = '1'
+os.environ.setdefault('SMTP_USER', 'benchmark@example.com')
+
+import manual_run
+from scripts import bigquery_updater, downloader, summarizer
+from scripts.chunk_index import CHUNK_INDEX_PATH, ChunkIndex
+from scripts.fakes import FakeBigQueryClient, FakeOpenAI, FakeSMTP
+from scripts.metrics import METRICS
+from scripts.municipality_index import MUNICIPALITIES_CSV, LINKS_CSV
+
+SAMPLES_DIR = 'municipalities_data'
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'pipeline_baseline.json')
+RECIPIENT = 'benchmark@example.com'
+REGRESSION_TOLERANCE = 0.25
+
+def sample_plans(samples_dir=SAMPLES_DIR) -> dict[str, str]:
+    plans = {}
+    for city in sorted(os.listdir(samples_dir)):
+        pdf_path = os.path.join(samples_dir, city, 'plan.pdf')
+        if not city.startswith('_') and os.path.isfile(pdf_path):
+            plans[city] = os.path.abspath(pdf_path)
+    return plans
+
+def fake_fetch(plans: dict[str, str], latency: float):
+    # místo geoportálu se plán zkopíruje ze vzorových dat
+    def fetch(url, file_path, _retry=True):
+        time.sleep(latency)
+        shutil.copyfile(plans[os.path.basename(os.path.dirname(file_path))], file_path)
+        return True
+    return fetch
+
+def prepare_workdir(root: str) -> None:
+    for csv_path in (MUNICIPALITIES_CSV, LINKS_CSV):
+        os.makedirs(os.path.join(root, os.path.dirname(csv_path)), exist_ok=True)
+        shutil.copyfile(csv_path, os.path.join(root, csv_path))
+
+def run_scenario(plans: dict[str, str], concurrency: int, llm_latency: float, download_latency: float) -> dict:
+    workdir = tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    repo_dir = os.getcwd()
+    prepare_workdir(workdir)
+    openai, outbox = FakeOpenAI(latency=llm_latency), []
+    # index podobných částí je modulový singleton s otevřeným spojením, každý scénář dostane vlastní
+    chunk_index = ChunkIndex(os.path.join(workdir, CHUNK_INDEX_PATH))
+    city_seconds = {}
+
+    def run_city(city):
+        start = time.perf_counter()
+        manual_run.run_pipeline(city, RECIPIENT)
+        city_seconds[city] = round(time.perf_counter() - start, 3)
+
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(summarizer, 'OpenAI', lambda api_key: openai))
+        stack.enter_context(mock.patch.object(bigquery_updater, 'get_client', lambda *a, **kw: FakeBigQueryClient()))
+        stack.enter_context(mock.patch.object(downloader, 'fetch_file', fake_fetch(plans, download_latency)))
+        stack.enter_context(mock.patch.object(smtplib, 'SMTP', lambda host, port: FakeSMTP(outbox, host, port)))
+        stack.enter_context(mock.patch.object(summarizer, 'CHUNK_INDEX', chunk_index))
+        # každý scénář začíná se studenými cache dokumentů, výsledků i indexu částí
+        os.chdir(workdir)
+        METRICS.reset()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            with redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(run_city, plans))
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            chunk_index.close()
+            os.chdir(repo_dir)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    metrics = METRICS.summary()
+    return {
+        'concurrency': concurrency,
+        'cities': len(plans),
+        'completed': len(outbox),
+        'elapsed_seconds': round(elapsed, 3),
+        'cities_per_minute': round(len(outbox) / elapsed * 60, 2) if elapsed else 0.0,
+        'peak_memory_mb': round(peak / 1e6, 1),
+        'llm_requests': openai.requests,
+        'city_seconds': city_seconds,
+        'steps': {step: round(s['seconds'], 3) for step, s in metrics['steps'].items()},
+    }
+
+def compare(results: list[dict], baseline: dict, tolerance=REGRESSION_TOLERANCE) -> list[str]:
+    regressions = []
+    for result in results:
+        base = baseline.get(str(result['concurrency']))
+        if not base:
+            continue
+        pairs = [('elapsed_seconds', result['elapsed_seconds'], base['elapsed_seconds']),
+                 ('peak_memory_mb', result['peak_memory_mb'], base['peak_memory_mb'])]
+        pairs += [(step, seconds, base['steps'].get(step)) for step, seconds in result['steps'].items()]
+        for name, value, previous in pairs:
+            # krátké kroky kolísají, porovnávají se jen ty nad 50 ms
+            if previous and max(value, previous) >= 0.05 and value > previous * (1 + tolerance):
+                regressions.append(f'N={result["concurrency"]} {name}: {previous} -> {value} (+{value / previous - 1:.0%})')
+    return regressions
+
+def print_results(results: list[dict]) -> None:
+    for r in results:
+        print(f"\nN={r['concurrency']}: {r['completed']}/{r['cities']} obcí za {r['elapsed_seconds']:.2f} s "
+              f"({r['cities_per_minute']:.1f} obcí/min), paměť {r['peak_memory_mb']:.1f} MB, "
+              f"LLM volání {r['llm_requests']}")
+        for step, seconds in r['steps'].items():
+            print(f'  {step:<28}{seconds:>9.3f} s')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark celé pipeline nad vzorovými plány.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4], help='Počty souběžně zpracovaných obcí')
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='Simulovaná latence jednoho volání LLM (s)')
+    parser.add_argument('--download-latency', type=float, default=0.2, help='Simulovaná doba stažení plánu (s)')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='Uložit výsledky jako nový baseline')
+    parser.add_argument('--check', action='store_true', help='Skončit chybou při zhoršení oproti baseline')
+    args = parser.parse_args(argv)
+
+    plans = sample_plans()
+    if not plans:
+        return print(f'V adresáři {SAMPLES_DIR} nejsou žádné vzorové plány.')
+    print(f'Benchmark pro {len(plans)} plánů: {", ".join(plans)}')
+    results = [run_scenario(plans, n, args.llm_latency, args.download_latency) for n in args.concurrency]
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({str(r['concurrency']): r for r in results}, f, ensure_ascii=False, indent=1)
+        return print(f'\nBaseline uložen do {args.baseline}')
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f))
+        print('\nZhoršení oproti baseline:' if regressions else '\nBez zhoršení oproti baseline.')
+        for line in regressions:
+            print(f'  {line}')
+        if regressions and args.check:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
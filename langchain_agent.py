@@ -5,7 +5,8 @@ from langchain.tools import tool
 from scripts.summarizer import analyze_issues_and_trends, generate_summary_txt
 from scripts.bigquery_updater import update_table
 from scripts.downloader import download_plan
-from manual_run import zip_city_folder, send_email
+from manual_run import send_email
+from scripts.packager import zip_city_folder
 import os
 
 
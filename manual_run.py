@@ -1,10 +1,13 @@
 import os
-import shutil
+import json
 import smtplib
 from email.message import EmailMessage
 from scripts.downloader import download_plan
 from scripts.summarizer import analyze_issues_and_trends, generate_summary_txt
 from scripts.bigquery_updater import update_table
+from scripts.llm_cache import LLM_CACHE
+from scripts.packager import zip_city_folder
+from scripts.metrics import METRICS
 from dotenv import load_dotenv
 
 
@@ -16,12 +19,6 @@ SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
 SMTP_USER = os.getenv('SMTP_USER')
 SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
 
-def zip_city_folder(city_name: str) -> str:
-    folder_path = os.path.join('municipalities_data', city_name)
-    zip_path = f'{folder_path}.zip'
-    shutil.make_archive(folder_path, 'zip', folder_path)
-    return zip_path
-
 def send_email(recipient: str, subject: str, body: str, attachment_path: str) -> None:
     msg = EmailMessage()
     msg['Subject'] = subject
@@ -61,6 +58,8 @@ def run_pipeline(city_name: str, recipient_email: str):
     send_email(recipient_email, subject, body, zip_path)
 
     print(f'Všechny procesy pro obec {city_name} byly úspěšně provedeny')
+    print(f'LLM cache: {LLM_CACHE.stats()}')
+    print(json.dumps(METRICS.summary(), ensure_ascii=False, indent=1))
 
 if __name__ == '__main__':
     import sys
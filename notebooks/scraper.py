@@ -1,10 +1,26 @@
-import requests
 import os
+import sys
+import json
+import hashlib
+import argparse
+import requests
 import pandas as pd
 
+# spouští se jako "python -m notebooks.scraper" i postaru "python notebooks/scraper.py";
+# v druhém případě není kořen repozitáře na sys.path a balíček scripts by se nenašel
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from scripts.blob_store import file_sha256
+from scripts.downloader import fetch_file
+from scripts.enrichment_store import ENRICHMENT_COLUMNS, ENRICHMENT_DB, EnrichmentStore
+from scripts.municipality_snapshot import build_snapshot
+from scripts.plan_events import melt_uur
+
 csu = 'https://csu.gov.cz/docs/107516/eab39014-0cbe-286f-46ae-d02abadcee8c/uap_obce.xlsx?version=2.0'
 uur = 'https://eupc.uur.cz/api/Dokumentace/PrehledAkciExport'
 dir = os.path.join(os.path.dirname(__file__), '../data_sources')
+cleansed_dir = os.path.join(os.path.dirname(__file__), '../cleansed_data')
+parquet_dir = os.path.join(dir, 'parquet')
 
 output_csu_xlsx = os.path.join(dir, 'csu_obce.xlsx')
 outputs_csu_csv = {
@@ -12,6 +28,13 @@ outputs_csu_csv = {
     'obce 2022': os.path.join(dir, 'stat_obce_2022.csv')
 }
 output_uur = 'uur_data.xlsx'
+output_uur_csv = os.path.join(dir, 'uur_data.csv')
+ruian_csv = os.path.join(dir, 'ruian_data.csv')
+codes_csv = os.path.join(dir, 'municipality_codes.csv')
+links_csv = os.path.join(cleansed_dir, 'municipalities_links.csv')
+enrichment_db = os.path.join(os.path.dirname(__file__), '..', ENRICHMENT_DB)
+output_municipalities = os.path.join(cleansed_dir, 'municipalities.csv')
+manifest_path = os.path.join(parquet_dir, 'manifest.json')
 
 uur_header = {
     'Content-Type': 'application/json',
@@ -32,33 +55,211 @@ uur_payload = {
     'operace': 1
 }
 
+# sloupce ČSÚ -> sloupce tabulky obcí (bez přípony roku)
+stat_columns = {
+    'Počet obyvatel': 'pocet_obyvatel',
+    'Přirozený přírůstek (osoba)': 'prirozeny_prirustek',
+    'Přírůstek stěhováním (osoba)': 'prirustek_stehovanim',
+    'Počet obyvatel ve věku 0-14 let ': 'obyvatele_0_14',
+    'Počet obyvatel ve věku 15-64 let': 'obyvatele_15_64',
+    'Počet obyvatel ve věku 65 a více let': 'obyvatele_65',
+    'Příjmy rozpočtů obcí celkem\n(tis. Kč)': 'prijmy',
+    'Výdaje\nrozpočtů\nobcí\ncelkem\n(tis. Kč)': 'vydaje',
+    'Počet dokončených bytů': 'dokoncene_byty',
+    'Počet hromadných ubytovacích zařízení celkem': 'ubytovaci_zarizeni',
+    'Podíl nezaměstna-\nných osob (%)': 'nezamestnanost',
+    'Živě narození': 'narozeni',
+    'Zemřelí': 'zemreli',
+    'Přistěhovalí': 'pristehovali',
+    'Vystěhovalí': 'vystehovali',
+    'Zemědělská půda (ha)': 'zemedelska_puda',
+    'Nezemědělská půda (ha)': 'nezemedelska_puda',
+    'Průměrný věk': 'prumerny_vek',
+    'Koeficient ekologické stability': 'koeficient_ekologie',
+}
+
 os.makedirs(dir, exist_ok=True)
+os.makedirs(parquet_dir, exist_ok=True)
+
+def read_manifest() -> dict:
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(manifest: dict):
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
 
-def download_csu():
-    r = requests.get(csu)
-    r.raise_for_status()
-    with open(output_csu_xlsx, 'wb') as f:
-        f.write(r.content)
+def _write_csv(df: pd.DataFrame, output_path: str):
+    tmp_path = f'{output_path}.tmp'
+    df.to_csv(tmp_path, index=False, encoding='utf-8-sig')
+    os.replace(tmp_path, output_path)
+    print(f'Soubor byl uložen {output_path}')
 
+def download_csu(force=False) -> bool:
+    '''Stáhne sešit ČSÚ jen při změně na serveru a všechny listy převede v jednom průchodu.'''
+    changed = fetch_file(csu, output_csu_xlsx)
+    sha256 = file_sha256(output_csu_xlsx)
+    manifest = read_manifest()
+    if not force and manifest.get('csu_obce.xlsx') == sha256 and all(map(os.path.exists, outputs_csu_csv.values())):
+        print(f'Data ČSÚ se nezměnila{"" if changed else " (304)"}')
+        return False
+
+    # sešit se otevře jednou pro všechny listy
+    sheets = pd.read_excel(output_csu_xlsx, sheet_name=list(outputs_csu_csv), skiprows=4, engine='openpyxl')
     for sheet_name, output_path in outputs_csu_csv.items():
-        df = pd.read_excel(output_csu_xlsx, sheet_name=sheet_name, skiprows=4, engine='openpyxl')
-        df.to_csv(output_path, index=False, encoding='utf-8-sig')
-        print(f'Soubor byl uložen {output_path}')
+        _write_csv(sheets[sheet_name], output_path)
+    write_manifest({**read_manifest(), 'csu_obce.xlsx': sha256})
+    return True
 
-def download_uur():
+def download_uur(force=False) -> bool:
+    '''Export ÚÚR je POST bez validátorů; nezměněný obsah se pozná podle hashe.'''
     response = requests.post(uur, json=uur_payload, headers=uur_header)
     response.raise_for_status()
+    sha256 = hashlib.sha256(response.content).hexdigest()
+    manifest = read_manifest()
+    if not force and manifest.get(output_uur) == sha256 and os.path.exists(output_uur_csv):
+        print('Export ÚÚR se nezměnil')
+        return False
+
     save_path_uur = os.path.join(dir, output_uur)
     with open(save_path_uur, 'wb') as f:
         f.write(response.content)
     uur_df = pd.read_excel(save_path_uur, engine='openpyxl')
-    save_path_uur_csv = os.path.join(dir, 'uur_data.csv')
-    uur_df.to_csv(save_path_uur_csv, index=False, encoding='utf-8-sig')
+    _write_csv(uur_df, output_uur_csv)
+    write_manifest({**read_manifest(), output_uur: sha256})
+    return True
 
-    print(f'Soubor byl uložen {save_path_uur_csv}')
+def _fix_mojibake(name):
+    # část zdrojů je v cp1250 chybně dekódovaná jako cp1252 (Èernošín, Dvùr)
+    try:
+        return name.encode('cp1252').decode('cp1250')
+    except (UnicodeError, AttributeError):
+        return name
 
-if __name__ == '__main__':
-    download_csu()
-    download_uur()
+def _numeric(df: pd.DataFrame) -> pd.DataFrame:
+    for col in df.columns:
+        values = pd.to_numeric(df[col], errors='coerce')
+        if values.notna().sum() == df[col].notna().sum():
+            df[col] = values
+    return df
+
+def _read_stat(path: str) -> pd.DataFrame:
+    # druhý řádek listu obsahuje jen rok
+    df = pd.read_csv(path, skiprows=[1], na_values='-', encoding='utf-8-sig', dtype=str)
+    return _numeric(df).dropna(subset=['kód obce číslo'])
 
+def _read_ruian(path: str) -> pd.DataFrame:
+    df = pd.read_csv(path, encoding='utf-8-sig')
+    df['NAZEV'] = df['NAZEV'].map(_fix_mojibake)
+    return df
+
+def _read_links(path: str) -> pd.DataFrame:
+    df = pd.read_csv(path, encoding='utf-8-sig', dtype={'municipality_kod': 'Int64'})
+    df['obec'] = df['obec'].map(_fix_mojibake)
+    return df
+
+sources = {
+    'stat_obce_2023': (outputs_csu_csv['obce 2023'], _read_stat),
+    'stat_obce_2022': (outputs_csu_csv['obce 2022'], _read_stat),
+    'ruian_data': (ruian_csv, _read_ruian),
+    'uur_data': (output_uur_csv, lambda path: pd.read_csv(path, dtype=str, encoding='utf-8-sig')),
+    'municipality_codes': (codes_csv, lambda path: pd.read_csv(path, encoding='utf-8-sig', dtype={'municipality_kod': 'Int64'})),
+    'municipalities_links': (links_csv, _read_links),
+}
 
+def source_hashes() -> dict:
+    return {name: file_sha256(path) for name, (path, _) in sources.items()}
+
+def load_source(name: str, sha256=None) -> pd.DataFrame:
+    '''Typovaný zdroj z Parquet cache; CSV se znovu parsuje jen při změně jeho hashe.'''
+    path, reader = sources[name]
+    sha256 = sha256 or file_sha256(path)
+    parquet_path = os.path.join(parquet_dir, f'{name}.parquet')
+    manifest = read_manifest()
+    if manifest.get('parquet', {}).get(name) == sha256 and os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path)
+
+    df = reader(path)
+    tmp_path = f'{parquet_path}.tmp'
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, parquet_path)
+    manifest = read_manifest()
+    manifest['parquet'] = {**manifest.get('parquet', {}), name: sha256}
+    write_manifest(manifest)
+    return df
+
+def latest_documents(uur_df: pd.DataFrame, municipalities: pd.DataFrame) -> pd.DataFrame:
+    '''Poslední dokumentace každé obce podle nejnovější události v exportu ÚÚR.'''
+    events = melt_uur(uur_df)
+    # export zná jen název obce; shodný název se přiřadí všem obcím toho jména
+    events = events.merge(municipalities[['obec', 'municipality_kod']], on='obec')
+    events = events.sort_values('date', kind='stable').drop_duplicates('municipality_kod', keep='last')
+    return pd.DataFrame({
+        'municipality_kod': events['municipality_kod'],
+        'posledni_dokumentace': events['document_name'],
+        'posledni_dokumentace_datum': events['date'].str[:7],
+    })
+
+def build_municipalities(force=False, output_path=output_municipalities) -> bool:
+    '''Sestaví tabulku obcí spojením zdrojů podle kódu obce; při nezměněných vstupech nic nedělá.'''
+    hashes = source_hashes()
+    built = read_manifest().get('municipalities', {})
+    if not force and built.get('sources') == hashes and os.path.exists(output_path) \
+            and built.get('output') == file_sha256(output_path):
+        print('Zdroje se nezměnily, tabulka obcí je aktuální')
+        return False
+    frames = {name: load_source(name, sha256) for name, sha256 in hashes.items()}
+
+    links = frames['municipalities_links'].dropna(subset=['municipality_kod'])
+    df = links[['obec', 'url', 'municipality_kod']].drop_duplicates('municipality_kod')
+
+    codes = frames['municipality_codes'].dropna(subset=['municipality_kod'])
+    kraj = codes.assign(kraj=codes['up_record_id'].str.rsplit('_', n=1).str[0])
+    df = df.merge(kraj[['municipality_kod', 'kraj']].drop_duplicates('municipality_kod'), on='municipality_kod', how='left')
+
+    ruian = frames['ruian_data'].rename(columns={'KOD': 'municipality_kod', 'POU_KOD': 'pou_kod', 'OKRES_KOD': 'okres_kod'})
+    df = df.merge(ruian[['municipality_kod', 'pou_kod', 'okres_kod']], on='municipality_kod', how='left')
+
+    for year in (2023, 2022):
+        stat = frames[f'stat_obce_{year}']
+        stat = stat[['kód obce číslo', *stat_columns]].rename(columns={
+            'kód obce číslo': 'municipality_kod', **{k: f'{v}_{year}' for k, v in stat_columns.items()}})
+        stat['municipality_kod'] = stat['municipality_kod'].astype('Int64')
+        df = df.merge(stat.drop_duplicates('municipality_kod'), on='municipality_kod', how='left')
+
+    df = df.merge(latest_documents(frames['uur_data'], df), on='municipality_kod', how='left')
+
+    # výstupy LLM jsou v úložišti obohacení; stávající tabulka doplní jen obce, které v něm chybí
+    enrichment = EnrichmentStore(enrichment_db).frame().astype({'municipality_kod': 'Int64'})
+    if os.path.exists(output_path):
+        previous = pd.read_csv(output_path, usecols=['municipality_kod', *ENRICHMENT_COLUMNS],
+                               dtype={'municipality_kod': 'Int64'})
+        enrichment = pd.concat([previous, enrichment], ignore_index=True)
+    df = df.merge(enrichment.drop_duplicates('municipality_kod', keep='last'), on='municipality_kod', how='left')
+
+    columns = ['obec', 'kraj', 'url', 'municipality_kod', 'pou_kod', 'okres_kod',
+               *(f'{c}_{year}' for year in (2023, 2022) for c in stat_columns.values()),
+               'posledni_dokumentace', 'posledni_dokumentace_datum',
+               *(f'{kind}_{i}' for i in range(1, 6) for kind in ('trend', 'problem'))]
+    _write_csv(df[columns], output_path)
+    build_snapshot(output_path)
+    write_manifest({**read_manifest(), 'municipalities': {'sources': hashes, 'output': file_sha256(output_path)}})
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stažení zdrojových dat a sestavení tabulky obcí.')
+    parser.add_argument('--skip-download', action='store_true', help='Jen znovu sestavit tabulku z místních souborů')
+    parser.add_argument('--force', action='store_true', help='Přeparsovat a sestavit i beze změny zdrojů')
+    args = parser.parse_args(argv)
+    if not args.skip_download:
+        download_csu(args.force)
+        download_uur(args.force)
+    build_municipalities(args.force)
+
+if __name__ == '__main__':
+    main()
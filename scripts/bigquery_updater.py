@@ -1,59 +1,154 @@
 from google.cloud import bigquery
 import pandas as pd
 import os
-import numpy as np
-from utils import int_cols, float_cols, str_cols, schema
+import uuid
+import threading
+from utils import schema
+from scripts.metrics import METRICS
+from scripts.municipality_snapshot import typed_frame
 
-def enforce_column_types(df, int_cols, float_cols, str_cols):
-    for col in int_cols:
-        df[col] = df[col].replace('', np.nan).astype('Int64')
+CREDS = 'google_credentials.json'
+PROJECT_ID = 'landscape-planning-agent'
+DATASET_ID = 'landscape_planning'
+TABLE_ID = 'municipalities'
+FLUSH_MAX_ROWS = int(os.getenv('BIGQUERY_FLUSH_ROWS', 500))
+FLUSH_MAX_SECONDS = float(os.getenv('BIGQUERY_FLUSH_SECONDS', 60))
 
-    for col in float_cols:
-        df[col] = df[col].replace('', np.nan).astype(float)
+_clients = {}
+_clients_lock = threading.Lock()
 
-    for col in str_cols:
-        df[col] = df[col].astype(str)
-    
-    return df
+def get_client(creds=CREDS, project_id=PROJECT_ID):
+    with _clients_lock:
+        key = (creds, project_id)
+        if key not in _clients:
+            _clients[key] = bigquery.Client.from_service_account_json(creds, project=project_id)
+        return _clients[key]
 
-def update_table(city_name: str,
-                          creds='google_credentials.json',
-                          project_id='landscape-planning-agent',
-                          dataset_id='landscape_planning',
-                          table_id='municipalities') -> bool:
-    try:
-        csv_path = f'municipalities_data/{city_name}/municipality_enriched.csv'
-        if not os.path.exists(csv_path):
-            print(f'Soubor nebyl nalezen {csv_path}')
-            return False
+class BigQueryUpserter:
+    def __init__(self, client=None, creds=CREDS, project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID,
+                 max_rows=FLUSH_MAX_ROWS, max_seconds=FLUSH_MAX_SECONDS, on_flush=None):
+        self._client = client
+        self.creds = creds
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.on_flush = on_flush
+        self._frames, self._keys = [], []
+        self._lock = threading.RLock()
+        self._timer = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_client(self.creds, self.project_id)
+        return self._client
+
+    def add(self, df: pd.DataFrame, key=None) -> None:
+        with self._lock:
+            self._frames.append(df)
+            self._keys.append(key)
+            rows = sum(len(f) for f in self._frames)
+            if rows >= self.max_rows:
+                # s on_flush se výsledek dávky hlásí přes callback, bez něj chybou
+                self._flush_quietly() if self.on_flush else self.flush()
+            elif self._timer is None and self.max_seconds:
+                self._timer = threading.Timer(self.max_seconds, self._flush_quietly)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> int:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._frames:
+                return 0
+            frames, keys = self._frames, self._keys
+            self._frames, self._keys = [], []
 
-        df = pd.read_csv(csv_path)
-        df = enforce_column_types(df, int_cols, float_cols, str_cols)
-        client = bigquery.Client.from_service_account_json(creds, project=project_id)
+        try:
+            df = pd.concat(frames, ignore_index=True)
+            df = df.drop_duplicates('municipality_kod', keep='last')
+            # stejné typy jako snapshot obcí, ale float64 a bez kategorií, které schéma BigQuery nezná
+            df = typed_frame(df, compact=False)
+            self._merge(df)
+            ok = True
+        except Exception as e:
+            # i chyba při přípravě dávky musí dojít do on_flush, jinak by na její obce čekalo navždy
+            print(f'Aktualizace v BigQuery selhala: {e}')
+            ok = False
+        if self.on_flush:
+            self.on_flush([k for k in keys if k is not None], ok)
+        if not ok:
+            raise RuntimeError('Dávková aktualizace v BigQuery selhala')
+        return len(df)
 
-        temp_table = f'{table_id}_temp'
-        temp = f'{project_id}.{dataset_id}.{temp_table}'
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except RuntimeError:
+            pass  # chyba už byla vypsána a předána do on_flush
 
+    @METRICS.timer('bigquery_merge')
+    def _merge(self, df: pd.DataFrame) -> None:
+        # unikátní dočasná tabulka, aby se souběžné dávky nepřepisovaly
+        temp = f'{self.project_id}.{self.dataset_id}.{self.table_id}_temp_{uuid.uuid4().hex[:12]}'
         job = bigquery.LoadJobConfig(
             schema=schema,
-            write_disposition='WRITE_TRUNCATE'
+            write_disposition='WRITE_TRUNCATE',
+            source_format=bigquery.SourceFormat.PARQUET,
         )
+        try:
+            self.client.load_table_from_dataframe(df, temp, job_config=job).result()
+            merge_sql = f'''
+            MERGE `{self.project_id}.{self.dataset_id}.{self.table_id}` T
+            USING `{temp}` S
+            ON T.municipality_kod = S.municipality_kod
+            WHEN MATCHED THEN UPDATE SET
+                {', '.join([f'T.{col} = S.{col}' for col in df.columns if col != 'municipality_kod'])}
+            WHEN NOT MATCHED THEN INSERT ROW
+            '''
+            self.client.query(merge_sql).result()
+        finally:
+            self.client.delete_table(temp, not_found_ok=True)
 
-        load_job = client.load_table_from_dataframe(df, temp, job_config=job)
-        load_job.result()
+    def close(self) -> None:
+        self._flush_quietly() if self.on_flush else self.flush()
 
-        merge_sql = f'''
-        MERGE `{project_id}.{dataset_id}.{table_id}` T
-        USING `{temp}` S
-        ON T.municipality_kod = S.municipality_kod
-        WHEN MATCHED THEN UPDATE SET
-            {', '.join([f'T.{col} = S.{col}' for col in df.columns if col != 'municipality_kod'])}
-        WHEN NOT MATCHED THEN INSERT ROW
-        '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_enriched(city_name: str) -> pd.DataFrame | None:
+    csv_path = f'municipalities_data/{city_name}/municipality_enriched.csv'
+    if not os.path.exists(csv_path):
+        print(f'Soubor nebyl nalezen {csv_path}')
+        return None
+    return pd.read_csv(csv_path)
+
+@METRICS.timer('bigquery')
+def update_table(city_name: str,
+                          creds=CREDS,
+                          project_id=PROJECT_ID,
+                          dataset_id=DATASET_ID,
+                          table_id=TABLE_ID,
+                          upserter=None) -> bool:
+    try:
+        df = load_enriched(city_name)
+        if df is None:
+            return False
 
-        client.query(merge_sql).result()
-        client.delete_table(temp, not_found_ok=True)
+        if upserter is not None:
+            upserter.add(df, key=city_name)
+            return True
 
+        with BigQueryUpserter(creds=creds, project_id=project_id, dataset_id=dataset_id, table_id=table_id,
+                              max_seconds=0) as single:
+            single.add(df)
         print(f'Tabulka v BigQuery byla aktualizovaná pro obec: {city_name}')
         return True
 
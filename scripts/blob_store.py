@@ -0,0 +1,39 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+BLOB_DIR = os.getenv('PLAN_BLOB_DIR', 'plan_blobs')
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def blob_path(sha256: str, blob_dir=BLOB_DIR) -> str:
+    return os.path.join(blob_dir, sha256[:2], f'{sha256}.pdf')
+
+def link_file(source: str, dest: str) -> None:
+    # hard link, a kde to souborový systém neumí, obyčejná kopie; cíl se nahrazuje atomicky
+    directory = os.path.dirname(dest) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, dest)
+
+def store_file(path: str, blob_dir=BLOB_DIR) -> str:
+    '''Uloží soubor do úložiště podle SHA-256 a nahradí ho odkazem na uloženou kopii.'''
+    sha256 = file_sha256(path)
+    blob = blob_path(sha256, blob_dir)
+    if not os.path.exists(blob):
+        link_file(path, blob)
+    if not os.path.samefile(path, blob):
+        link_file(blob, path)
+    return sha256
@@ -0,0 +1,144 @@
+import os
+import re
+import sys
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from scripts.municipality_index import normalize_name
+
+CHUNK_INDEX_PATH = os.getenv('CHUNK_INDEX_PATH', 'cache/chunk_index.sqlite')
+DEDUP_DISABLED = os.getenv('DEDUP_DISABLE') == '1'
+# odhad Jaccardovy podobnosti, od kterého se část považuje za téměř shodnou
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', 0.85))
+SHINGLE_SIZE = 5
+NUM_PERM = 64
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.RandomState(20240601)
+_PERM_A = _rng.randint(1, 1 << 32, NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, 1 << 32, NUM_PERM, dtype=np.uint64)
+WORD = re.compile(r'\w+')
+
+def _shingles(text: str) -> set[bytes]:
+    words = WORD.findall(normalize_name(text))
+    if len(words) < SHINGLE_SIZE:
+        return {' '.join(words).encode()} if words else set()
+    return {' '.join(words[i:i + SHINGLE_SIZE]).encode() for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def signature(text: str) -> np.ndarray | None:
+    '''MinHash podpis části; stejné parametry permutací napříč procesy, takže podpisy lze ukládat.'''
+    shingles = _shingles(text)
+    if not shingles:
+        return None
+    hashes = np.fromiter((zlib.crc32(s) for s in shingles), dtype=np.uint64, count=len(shingles))
+    permuted = (np.outer(_PERM_A, hashes) + _PERM_B[:, None]) % _MERSENNE_PRIME
+    return (permuted.min(axis=1) & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+def _band_keys(sig: np.ndarray) -> list[int]:
+    keys = []
+    for band in range(BANDS):
+        digest = hashlib.blake2b(sig[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, 'big', signed=True))
+    return keys
+
+class DedupStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.analysed = 0
+
+    def record(self, reused: bool) -> None:
+        with self._lock:
+            if reused:
+                self.reused += 1
+            else:
+                self.analysed += 1
+
+    @property
+    def ratio(self) -> float:
+        total = self.reused + self.analysed
+        return self.reused / total if total else 0.0
+
+class ChunkIndex:
+    '''Trvalý LSH index MinHash podpisů analyzovaných částí napříč celým korpusem plánů.'''
+
+    def __init__(self, path=CHUNK_INDEX_PATH, threshold=DEDUP_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY,
+                    variant TEXT,
+                    signature BLOB,
+                    analysis TEXT,
+                    reused INTEGER DEFAULT 0,
+                    created REAL
+                )''')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS bands (band INTEGER, key INTEGER, chunk_id INTEGER)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS bands_key ON bands(band, key)')
+            self._conn.commit()
+        return self._conn
+
+    def find(self, sig: np.ndarray, variant: str) -> str | None:
+        '''Vrátí analýzu nejpodobnější uložené části, pokud je podobnost nad prahem.'''
+        with self._lock:
+            db = self._db()
+            candidates = set()
+            for band, key in enumerate(_band_keys(sig)):
+                candidates.update(r[0] for r in db.execute(
+                    'SELECT chunk_id FROM bands WHERE band = ? AND key = ?', (band, key)))
+            best, best_score = None, self.threshold
+            for chunk_id in candidates:
+                row = db.execute('SELECT signature, analysis FROM chunks WHERE id = ? AND variant = ?',
+                                 (chunk_id, variant)).fetchone()
+                if row is None:
+                    continue
+                score = similarity(sig, np.frombuffer(row[0], dtype=np.uint32))
+                if score >= best_score:
+                    best, best_score = (chunk_id, row[1]), score
+            if best is None:
+                return None
+            db.execute('UPDATE chunks SET reused = reused + 1 WHERE id = ?', (best[0],))
+            db.commit()
+            return best[1]
+
+    def add(self, sig: np.ndarray, variant: str, analysis: str) -> None:
+        with self._lock:
+            db = self._db()
+            cursor = db.execute('INSERT INTO chunks (variant, signature, analysis, created) VALUES (?, ?, ?, ?)',
+                                (variant, sig.tobytes(), analysis, time.time()))
+            db.executemany('INSERT INTO bands VALUES (?, ?, ?)',
+                           [(band, key, cursor.lastrowid) for band, key in enumerate(_band_keys(sig))])
+            db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, reused = self._db().execute('SELECT COUNT(*), COALESCE(SUM(reused), 0) FROM chunks').fetchone()
+        total = entries + reused
+        return {'entries': entries, 'reused': reused, 'dedup_ratio': reused / total if total else 0.0}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+CHUNK_INDEX = ChunkIndex()
+
+if __name__ == '__main__':
+    print(ChunkIndex(*sys.argv[1:2]).stats())
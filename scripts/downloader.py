@@ -1,32 +1,150 @@
 import os
-import pandas as pd
+import json
+import shutil
+import hashlib
+import threading
+from urllib.parse import urlsplit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from scripts.municipality_index import LINKS_CSV, AmbiguousMunicipality, get_index
+from scripts.blob_store import link_file, store_file
+from scripts.metrics import METRICS
 
+DOWNLOAD_TIMEOUT = (10, 120)
+DOWNLOAD_BLOCK_SIZE = 1 << 16
+POOL_SIZE_PER_HOST = 8
+PLAN_CORPUS_DIR = os.getenv('PLAN_CORPUS_DIR', 'plan_corpus')
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+def get_session(url: str) -> requests.Session:
+    # jedna keep-alive session na hostitele, spojení se znovu používají mezi obcemi
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            retry = Retry(total=3, backoff_factor=1, status_forcelist=(502, 503, 504), allowed_methods=('GET',))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE_PER_HOST, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+        return _sessions[host]
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_meta(meta_path, meta):
+    tmp_path = f'{meta_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+def fetch_file(url: str, file_path: str, _retry=True) -> bool:
+    '''Stáhne soubor po částech přes dočasný .part soubor. Vrací False, pokud se soubor na serveru nezměnil.'''
+    meta_path = f'{file_path}.meta.json'
+    part_path = f'{file_path}.part'
+    meta = _read_meta(meta_path)
+    headers = {}
+
+    partial = meta.get('partial') if os.path.exists(part_path) else None
+    if partial and partial.get('url') == url and (partial.get('etag') or partial.get('last_modified')):
+        # navázání přerušeného přenosu; If-Range zajistí celý soubor, pokud se mezitím změnil
+        headers['Range'] = f'bytes={os.path.getsize(part_path)}-'
+        headers['If-Range'] = partial.get('etag') or partial['last_modified']
+    elif os.path.exists(file_path) and meta.get('url') == url:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with get_session(url).get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 304:
+            return False
+        if response.status_code == 416 and _retry:
+            os.remove(part_path)
+            return fetch_file(url, file_path, _retry=False)
+        response.raise_for_status()
+
+        validators = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        resumed = response.status_code == 206
+        if not resumed:
+            _write_meta(meta_path, {**meta, 'partial': validators})
+        with open(part_path, 'ab' if resumed else 'wb') as f:
+            for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                f.write(block)
+
+    os.replace(part_path, file_path)
+    _write_meta(meta_path, validators if not resumed else partial)
+    return True
+
+def corpus_path(url: str, corpus_dir=PLAN_CORPUS_DIR) -> str:
+    return os.path.join(corpus_dir, f'{hashlib.sha1(url.encode()).hexdigest()[:20]}.bin')
+
+def seed_from_corpus(url: str, file_path: str, corpus_dir=PLAN_CORPUS_DIR) -> bool:
+    '''Převezme soubor předem stažený hromadným prefetchem, pokud obec ještě žádný nemá.'''
+    cached = corpus_path(url, corpus_dir)
+    if os.path.exists(file_path) or not os.path.exists(cached):
+        return False
+    link_file(cached, file_path)
+    if os.path.exists(f'{cached}.meta.json'):
+        shutil.copyfile(f'{cached}.meta.json', f'{file_path}.meta.json')
+    return True
+
+def store_download(file_path: str) -> str:
+    '''Přesune stažený soubor do úložiště podle obsahu a zapíše jeho SHA-256 k validátorům.'''
+    sha256 = store_file(file_path)
+    meta_path = f'{file_path}.meta.json'
+    meta = _read_meta(meta_path)
+    if meta.get('sha256') != sha256:
+        _write_meta(meta_path, {**meta, 'sha256': sha256})
+    return sha256
+
+@METRICS.timer('download')
 def download_plan(city_name: str,
-                  csv_path='cleansed_data/municipalities_links.csv',
-                  output_dir='municipalities_data') -> str | None:
+                  csv_path=LINKS_CSV,
+                  output_dir='municipalities_data',
+                  kraj=None,
+                  okres=None) -> str | None:
     try:
-        df = pd.read_csv(csv_path)
+        links = get_index(csv_path)
+        municipality = get_index().resolve(city_name, kraj, okres) or links.resolve(city_name)
+        link = links.by_kod(municipality['municipality_kod']) if municipality else None
+    except AmbiguousMunicipality as e:
+        print(e)
+        return None
     except Exception as e:
         print(f'Nepovedlo se načíst CSV soubor: {e}')
         return None
 
-    match = df[df['obec'].str.lower() == city_name.lower()]
-    if match.empty:
+    if link is None:
         print(f'Obec "{city_name}" nebyla nalezena v CSV souboru.')
         return None
 
-    url = match.iloc[0]['url'].strip('{}')
+    url = link['url'].strip('{}')
     city_folder = os.path.join(output_dir, city_name)
     os.makedirs(city_folder, exist_ok=True)
     file_path = os.path.join(city_folder, 'plan.pdf')
 
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
-        print(f'Územní plán byl stažen do adresáře: {file_path}')
+        # s validátory z prefetche stačí podmíněný dotaz, který obvykle skončí 304
+        seed_from_corpus(url, file_path)
+        previous = _read_meta(f'{file_path}.meta.json').get('sha256')
+        changed = fetch_file(url, file_path)
+        sha256 = store_download(file_path)
+        if changed and sha256 != previous:
+            print(f'Územní plán byl stažen do adresáře: {file_path}')
+        else:
+            print(f'Územní plán se od posledního stažení nezměnil: {file_path}')
         return file_path
     except Exception as e:
         print(f'Nepovedlo se stáhnout soubor: {e}')
@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+import pandas as pd
+from scripts.municipality_snapshot import MUNICIPALITIES_CSV, build_snapshot, load_municipalities
+
+ENRICHMENT_DB = os.getenv('ENRICHMENT_DB', 'cleansed_data/enrichment.sqlite')
+ENRICHMENT_COLUMNS = [f'{kind}_{i}' for i in range(1, 6) for kind in ('trend', 'problem')]
+
+class EnrichmentStore:
+    def __init__(self, path=ENRICHMENT_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        # každé vlákno má vlastní spojení; souběh zápisů řeší SQLite transakce
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            columns = ', '.join(f'{c} TEXT' for c in ENRICHMENT_COLUMNS)
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS enrichment (
+                    municipality_kod INTEGER PRIMARY KEY,
+                    obec TEXT,
+                    {columns},
+                    updated REAL
+                )''')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def upsert(self, municipality_kod: int, obec: str, problems: list[str], trends: list[str]) -> dict:
+        values = {}
+        for i in range(5):
+            values[f'problem_{i+1}'] = problems[i] if i < len(problems) else ''
+            values[f'trend_{i+1}'] = trends[i] if i < len(trends) else ''
+        columns = ['municipality_kod', 'obec', *ENRICHMENT_COLUMNS, 'updated']
+        params = [int(municipality_kod), obec, *(values[c] for c in ENRICHMENT_COLUMNS), time.time()]
+        updates = ', '.join(f'{c} = excluded.{c}' for c in columns[1:])
+        db = self._db()
+        with db:
+            db.execute(f'''
+                INSERT INTO enrichment ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+                ON CONFLICT(municipality_kod) DO UPDATE SET {updates}''', params)
+        return values
+
+    def get(self, municipality_kod: int) -> dict | None:
+        cursor = self._db().execute('SELECT * FROM enrichment WHERE municipality_kod = ?', (int(municipality_kod),))
+        row = cursor.fetchone()
+        return dict(zip([d[0] for d in cursor.description], row)) if row else None
+
+    def frame(self) -> pd.DataFrame:
+        return pd.read_sql_query(f"SELECT municipality_kod, {', '.join(ENRICHMENT_COLUMNS)} FROM enrichment", self._db())
+
+    def export_snapshot(self, output_path=MUNICIPALITIES_CSV, base_csv=MUNICIPALITIES_CSV) -> str:
+        base = load_municipalities(base_csv, compact=False)
+        enriched = self.frame().set_index('municipality_kod')
+        base = base.set_index(base['municipality_kod'].astype('Int64'))
+        base[ENRICHMENT_COLUMNS] = base[ENRICHMENT_COLUMNS].astype(object)
+        # uložené hodnoty mají přednost před sloupci ve výchozí tabulce
+        base.update(enriched)
+        base = base.reset_index(drop=True)
+        tmp_path = f'{output_path}.tmp'
+        if output_path.endswith('.parquet'):
+            base.to_parquet(tmp_path, index=False)
+        else:
+            base.to_csv(tmp_path, index=False, encoding='utf-8-sig')
+        os.replace(tmp_path, output_path)
+        if output_path.endswith('.csv'):
+            build_snapshot(output_path)
+        print(f'Snapshot obohacených dat byl uložen zde: {output_path}')
+        return output_path
+
+ENRICHMENT_STORE = EnrichmentStore()
+
+if __name__ == '__main__':
+    ENRICHMENT_STORE.export_snapshot(*sys.argv[1:2])
@@ -0,0 +1,88 @@
+import re
+import time
+import threading
+from types import SimpleNamespace
+import pandas as pd
+
+class _DoneJob:
+    def result(self):
+        return self
+
+class FakeBigQueryClient:
+    '''Lokální náhrada bigquery.Client pro testy a benchmarky bez přístupu ke cloudu.'''
+
+    def __init__(self):
+        self.tables: dict[str, pd.DataFrame] = {}
+        self.calls: list[tuple[str, str]] = []
+
+    def load_table_from_dataframe(self, df, table, job_config=None):
+        self.calls.append(('load', table))
+        self.tables[table] = df.copy()
+        return _DoneJob()
+
+    def query(self, sql):
+        self.calls.append(('query', sql))
+        match = re.search(r'MERGE `([^`]+)` T\s+USING `([^`]+)` S', sql)
+        if match:
+            target, source = match.groups()
+            current = self.tables.get(target, pd.DataFrame())
+            merged = pd.concat([current, self.tables[source]], ignore_index=True)
+            self.tables[target] = merged.drop_duplicates('municipality_kod', keep='last').reset_index(drop=True)
+        return _DoneJob()
+
+    def delete_table(self, table, not_found_ok=False):
+        self.calls.append(('delete', table))
+        if table not in self.tables and not not_found_ok:
+            raise KeyError(table)
+        self.tables.pop(table, None)
+
+FAKE_ANALYSIS = '''Hlavní problémy:
+- Nedostatečná kapacita dopravní infrastruktury
+- Úbytek zemědělské půdy
+Hlavní trendy:
+- Suburbanizace a rozvoj bydlení
+- Posilování zelené infrastruktury'''
+
+class FakeOpenAI:
+    '''Lokální náhrada klienta OpenAI s nastavitelnou latencí a počtem tokenů.'''
+
+    def __init__(self, api_key=None, latency=0.05, completion_tokens=120, prompt_tokens=None, content=FAKE_ANALYSIS):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.prompt_tokens = prompt_tokens
+        self.content = content
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, **kwargs):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        # bez zadaného počtu se vstupní tokeny odhadnou jako čtvrtina znaků
+        prompt_tokens = self.prompt_tokens or sum(len(m['content']) for m in messages) // 4
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=self.content))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=self.completion_tokens),
+        )
+
+class FakeSMTP:
+    '''Lokální náhrada smtplib.SMTP; odeslané zprávy ukládá do outbox.'''
+
+    def __init__(self, outbox: list, host=None, port=None):
+        self.outbox = outbox
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def send_message(self, msg):
+        self.outbox.append(msg)
@@ -0,0 +1,104 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+
+CACHE_PATH = os.getenv('LLM_CACHE_PATH', 'cache/llm_cache.sqlite')
+CACHE_MAX_AGE_DAYS = float(os.getenv('LLM_CACHE_MAX_AGE_DAYS', 90))
+CACHE_MAX_MB = float(os.getenv('LLM_CACHE_MAX_MB', 200))
+CACHE_DISABLED = os.getenv('LLM_CACHE_DISABLE') == '1'
+EVICT_EVERY = 50
+
+def cache_key(model: str, system: str, prompt: str) -> str:
+    h = hashlib.sha256()
+    for part in (model, system, prompt):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+class LLMCache:
+    def __init__(self, path=CACHE_PATH, max_age_days=CACHE_MAX_AGE_DAYS, max_mb=CACHE_MAX_MB):
+        self.path = path
+        self.max_age = max_age_days * 86400
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT,
+                    size INTEGER,
+                    created REAL,
+                    accessed REAL
+                )''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)')
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            db = self._db()
+            row = db.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+            db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, model: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, model, response, len(response.encode('utf-8')), now, now))
+            db.commit()
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 1:
+                self._evict(db)
+
+    def _evict(self, db):
+        db.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.max_age,))
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total > self.max_bytes:
+            # nejdéle nepoužité odpovědi odcházejí první, dokud se cache nevejde do limitu
+            excess = total - self.max_bytes
+            for key, size in db.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall():
+                if excess <= 0:
+                    break
+                db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                excess -= size
+        db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            db = self._db()
+            db.execute('DELETE FROM responses')
+            db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            db = self._db()
+            entries, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': size,
+        }
+
+LLM_CACHE = LLMCache()
@@ -0,0 +1,140 @@
+import time
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+
+METRICS_PREFIX = 'uzemni'
+# USD za milion tokenů (vstup, výstup); neznámý model se počítá jako zdarma
+MODEL_PRICES = {
+    'gpt-3.5-turbo': (0.50, 1.50),
+    'o4-mini': (1.10, 4.40),
+}
+
+_current_city = contextvars.ContextVar('metrics_city', default=None)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels) -> str:
+    items = [f'{k}="{_escape(v)}"' for k, v in labels.items() if v is not None]
+    return '{' + ','.join(items) + '}' if items else ''
+
+class Stopwatch:
+    '''Sčítá čas strávený uvnitř iterátoru, bez času, kdy s položkami pracuje volající.'''
+    def __init__(self):
+        self.seconds = 0.0
+
+    def iterate(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds += time.perf_counter() - start
+                return
+            self.seconds += time.perf_counter() - start
+            yield item
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._steps = defaultdict(lambda: {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            self._tokens = defaultdict(lambda: {'requests': 0, 'prompt': 0, 'completion': 0})
+            self._cost = defaultdict(float)
+            self._cache = defaultdict(lambda: {'hits': 0, 'misses': 0})
+            self._counters = defaultdict(int)
+
+    def observe(self, step: str, seconds: float, model=None) -> None:
+        with self._lock:
+            s = self._steps[(step, model)]
+            s['count'] += 1
+            s['seconds'] += seconds
+            s['max'] = max(s['max'], seconds)
+
+    @contextmanager
+    def timer(self, step: str, model=None):
+        '''Měří blok kódu; lze použít i jako dekorátor funkce.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(step, time.perf_counter() - start, model)
+
+    @contextmanager
+    def city(self, city_name: str):
+        '''Náklady na LLM volání uvnitř bloku se připíšou této obci.'''
+        token = _current_city.set(city_name)
+        try:
+            yield
+        finally:
+            _current_city.reset(token)
+
+    def record_usage(self, model: str, usage) -> None:
+        prompt = getattr(usage, 'prompt_tokens', 0) or 0
+        completion = getattr(usage, 'completion_tokens', 0) or 0
+        price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+        cost = (prompt * price_in + completion * price_out) / 1e6
+        with self._lock:
+            t = self._tokens[model]
+            t['requests'] += 1
+            t['prompt'] += prompt
+            t['completion'] += completion
+            self._cost[_current_city.get() or ''] += cost
+
+    def count(self, name: str, value=1, **labels) -> None:
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def cache_lookup(self, cache: str, hit: bool) -> None:
+        with self._lock:
+            self._cache[cache]['hits' if hit else 'misses'] += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            steps = {}
+            for (step, model), s in sorted(self._steps.items(), key=lambda i: (i[0][0], i[0][1] or '')):
+                name = f'{step}[{model}]' if model else step
+                steps[name] = {**s, 'avg': s['seconds'] / s['count'] if s['count'] else 0.0}
+            caches = {name: {**c, 'hit_rate': c['hits'] / (c['hits'] + c['misses']) if c['hits'] + c['misses'] else 0.0}
+                      for name, c in sorted(self._cache.items())}
+            return {
+                'steps': steps,
+                'tokens': {model: dict(t) for model, t in sorted(self._tokens.items())},
+                'cost_usd': {city or '-': round(cost, 6) for city, cost in sorted(self._cost.items())},
+                'caches': caches,
+                'counters': {name + _labels(**dict(labels)): value for (name, labels), value in sorted(self._counters.items())},
+            }
+
+    def render_prometheus(self) -> str:
+        p = METRICS_PREFIX
+        lines = [f'# HELP {p}_step_seconds Doba trvání kroků pipeline', f'# TYPE {p}_step_seconds summary']
+        with self._lock:
+            for (step, model), s in sorted(self._steps.items(), key=lambda i: (i[0][0], i[0][1] or '')):
+                labels = _labels(step=step, model=model)
+                lines.append(f'{p}_step_seconds_count{labels} {s["count"]}')
+                lines.append(f'{p}_step_seconds_sum{labels} {s["seconds"]:.6f}')
+            lines += [f'# HELP {p}_llm_requests_total Počet volání LLM API', f'# TYPE {p}_llm_requests_total counter']
+            lines += [f'{p}_llm_requests_total{_labels(model=m)} {t["requests"]}' for m, t in sorted(self._tokens.items())]
+            lines += [f'# HELP {p}_llm_tokens_total Spotřebované tokeny', f'# TYPE {p}_llm_tokens_total counter']
+            for model, t in sorted(self._tokens.items()):
+                lines.append(f'{p}_llm_tokens_total{_labels(model=model, kind="prompt")} {t["prompt"]}')
+                lines.append(f'{p}_llm_tokens_total{_labels(model=model, kind="completion")} {t["completion"]}')
+            lines += [f'# HELP {p}_llm_cost_usd_total Odhadovaná cena LLM volání', f'# TYPE {p}_llm_cost_usd_total counter']
+            lines += [f'{p}_llm_cost_usd_total{_labels(city=city or None)} {cost:.6f}' for city, cost in sorted(self._cost.items())]
+            lines += [f'# HELP {p}_cache_lookups_total Dotazy do cache', f'# TYPE {p}_cache_lookups_total counter']
+            for cache, c in sorted(self._cache.items()):
+                lines.append(f'{p}_cache_lookups_total{_labels(cache=cache, result="hit")} {c["hits"]}')
+                lines.append(f'{p}_cache_lookups_total{_labels(cache=cache, result="miss")} {c["misses"]}')
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f'# TYPE {p}_{name}_total counter')
+                lines += [f'{p}_{name}_total{_labels(**dict(labels))} {value}'
+                          for (n, labels), value in sorted(self._counters.items()) if n == name]
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
@@ -0,0 +1,90 @@
+import os
+import threading
+import unicodedata
+import pandas as pd
+from scripts.municipality_snapshot import MUNICIPALITIES_CSV, load_municipalities
+
+LINKS_CSV = 'cleansed_data/municipalities_links.csv'
+
+def normalize_name(name: str) -> str:
+    decomposed = unicodedata.normalize('NFKD', str(name))
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.lower().split())
+
+class AmbiguousMunicipality(Exception):
+    def __init__(self, name: str, candidates: list[dict]):
+        options = ', '.join(f"{c['obec']} ({c.get('kraj', '?')}, okres {c.get('okres_kod', '?')}, kód {c['municipality_kod']})"
+                            for c in candidates)
+        super().__init__(f'Název "{name}" odpovídá více obcím: {options}. Upřesněte kraj, okres nebo kód obce.')
+        self.candidates = candidates
+
+class MunicipalityIndex:
+    def __init__(self, csv_path: str):
+        self.csv_path = csv_path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._by_kod = {}
+        self._by_name = {}
+
+    def _refresh(self):
+        mtime = os.path.getmtime(self.csv_path)
+        if mtime == self._mtime:
+            return
+        # řádky se vydávají jako slovníky, float32 a kategorie by se do nich jen propsaly
+        df = load_municipalities(self.csv_path, compact=False)
+        df['municipality_kod'] = df['municipality_kod'].astype('Int64')
+        by_kod, by_name = {}, {}
+        for row in df.to_dict('records'):
+            if pd.isna(row['municipality_kod']):
+                continue
+            row['municipality_kod'] = int(row['municipality_kod'])
+            by_kod.setdefault(row['municipality_kod'], row)
+            by_name.setdefault(normalize_name(row['obec']), []).append(row)
+        self._by_kod, self._by_name, self._mtime = by_kod, by_name, mtime
+
+    def _current(self):
+        with self._lock:
+            self._refresh()
+            return self._by_kod, self._by_name
+
+    def by_kod(self, kod) -> dict | None:
+        by_kod, _ = self._current()
+        return by_kod.get(int(kod))
+
+    def by_name(self, name: str, kraj=None, okres=None) -> list[dict]:
+        _, by_name = self._current()
+        rows = by_name.get(normalize_name(name), [])
+        if kraj:
+            rows = [r for r in rows if normalize_name(r.get('kraj', '')) == normalize_name(kraj)]
+        if okres:
+            rows = [r for r in rows if str(r.get('okres_kod')) == str(okres)]
+        return rows
+
+    def resolve(self, query, kraj=None, okres=None) -> dict | None:
+        # číselný dotaz je kód obce, jinak název bez ohledu na diakritiku a velikost písmen
+        if str(query).strip().isdigit():
+            return self.by_kod(query)
+        rows = self.by_name(query, kraj, okres)
+        if len(rows) > 1:
+            raise AmbiguousMunicipality(query, rows)
+        return rows[0] if rows else None
+
+    def rows(self) -> list[dict]:
+        by_kod, _ = self._current()
+        return list(by_kod.values())
+
+_INDEXES: dict[str, MunicipalityIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+def get_index(csv_path=MUNICIPALITIES_CSV) -> MunicipalityIndex:
+    with _INDEXES_LOCK:
+        if csv_path not in _INDEXES:
+            _INDEXES[csv_path] = MunicipalityIndex(csv_path)
+        return _INDEXES[csv_path]
+
+def resolve_municipality(query, kraj=None, okres=None, csv_path=MUNICIPALITIES_CSV) -> dict | None:
+    try:
+        return get_index(csv_path).resolve(query, kraj, okres)
+    except AmbiguousMunicipality as e:
+        print(e)
+        return None
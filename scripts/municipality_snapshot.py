@@ -0,0 +1,128 @@
+import os
+import sys
+import tempfile
+import pandas as pd
+import pyarrow as pa
+from utils import int_cols, float_cols, str_cols
+from scripts.blob_store import file_sha256
+
+MUNICIPALITIES_CSV = 'cleansed_data/municipalities.csv'
+SNAPSHOT_SUFFIX = '.arrow'
+# v souboru jsou desetinná čísla vždy float64; starší snapshoty s float32 se přestaví
+SNAPSHOT_VERSION = '2'
+# rozpočty v tis. Kč přesahují přesnost float32, ostatní podíly a výměry ne
+FLOAT64_COLS = ('prijmy_2023', 'vydaje_2023', 'prijmy_2022', 'vydaje_2022')
+# málo různých hodnot opakovaných v tisících řádků
+CATEGORY_COLS = ('kraj', 'okres_kod')
+
+_PANDAS_TYPES = {
+    pa.int32(): pd.Int32Dtype(),
+    pa.int64(): pd.Int64Dtype(),
+}
+
+def snapshot_path(csv_path: str) -> str:
+    return f'{os.path.splitext(csv_path)[0]}{SNAPSHOT_SUFFIX}'
+
+def _arrow_type(col: str) -> pa.DataType | None:
+    if col in int_cols:
+        return pa.int32()
+    if col in float_cols:
+        return pa.float64()
+    if col in str_cols:
+        return pa.string()
+    return None
+
+def to_table(df: pd.DataFrame, compact=True) -> pa.Table:
+    '''Převede tabulku obcí na Arrow podle typů z utils; sloupce mimo seznamy si typ odvodí samy.
+    Bez compact jsou i kraj a okres prosté hodnoty místo kategorií, jak je čeká BigQuery.'''
+    columns = {}
+    for col in df.columns:
+        values, arrow_type = df[col], _arrow_type(col)
+        if col == 'url':
+            values = values.str.strip('{}')
+        if arrow_type is None:
+            array = pa.array(values, from_pandas=True)
+        elif pa.types.is_string(arrow_type):
+            array = pa.array(values.astype(object).where(values.notna(), None), type=arrow_type)
+        else:
+            # float se zaokrouhlenými celými čísly (100.0) se bezpečně převede na int32
+            array = pa.array(pd.to_numeric(values, errors='coerce'), type=arrow_type, from_pandas=True)
+        if compact and col in CATEGORY_COLS:
+            array = array.dictionary_encode()
+        columns[col] = array
+    return pa.table(columns)
+
+def _to_pandas(table: pa.Table, compact=True) -> pd.DataFrame:
+    df = table.to_pandas(types_mapper=_PANDAS_TYPES.get)
+    if compact:
+        # float32 jen v pohledu pro čtení; co se dál zapisuje, bere compact=False s přesnými float64
+        for col in df.select_dtypes('float64').columns:
+            if col in float_cols and col not in FLOAT64_COLS:
+                df[col] = df[col].astype('float32')
+    else:
+        for col in df.select_dtypes('category').columns:
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
+
+def typed_frame(df: pd.DataFrame, compact=True) -> pd.DataFrame:
+    return _to_pandas(to_table(df, compact), compact)
+
+def _snapshot_metadata(path: str) -> dict:
+    try:
+        with pa.memory_map(path) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return {}
+    return {key.decode(): value.decode() for key, value in metadata.items()}
+
+def _snapshot_source(path: str) -> str | None:
+    metadata = _snapshot_metadata(path)
+    if metadata.get('version') != SNAPSHOT_VERSION:
+        return None
+    return metadata.get('source_sha256') or None
+
+def build_snapshot(csv_path=MUNICIPALITIES_CSV, force=False) -> str:
+    '''Zapíše typovaný Arrow snapshot CSV vedle něj; beze změny obsahu CSV jen obnoví čas souboru.'''
+    path = snapshot_path(csv_path)
+    sha256 = file_sha256(csv_path)
+    if not force and _snapshot_source(path) == sha256:
+        os.utime(path)
+        return path
+
+    table = to_table(pd.read_csv(csv_path, encoding='utf-8-sig'))
+    table = table.replace_schema_metadata({'source_sha256': sha256, 'version': SNAPSHOT_VERSION})
+    # vlastní dočasný soubor pro každý zápis, souběžné přestavby si ho nepřepíšou
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.', suffix='.tmp', delete=False) as tmp:
+        tmp_path = tmp.name
+    try:
+        # bez komprese, aby šel soubor namapovat do paměti bez kopírování
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return path
+
+def load_table(path: str, columns=None) -> pa.Table:
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.select(columns) if columns else table
+
+def load_municipalities(csv_path=MUNICIPALITIES_CSV, columns=None, compact=True) -> pd.DataFrame:
+    '''Tabulka obcí z namapovaného snapshotu; zastaralý snapshot se nejdřív přestaví z CSV.
+    compact=True je pohled jen pro čtení (float32, kategorie); compact=False vrací přesné float64
+    a hodnoty místo kategorií pro další zápis do CSV nebo BigQuery.'''
+    path = snapshot_path(csv_path)
+    try:
+        if (not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(csv_path)
+                or _snapshot_metadata(path).get('version') != SNAPSHOT_VERSION):
+            build_snapshot(csv_path)
+        return _to_pandas(load_table(path, columns), compact)
+    except OSError as e:
+        # např. adresář jen pro čtení; CSV zůstává zdrojem pravdy
+        print(f'Snapshot {path} nelze použít ({e}), čte se CSV')
+        return pd.read_csv(csv_path, usecols=columns, encoding='utf-8-sig')
+
+if __name__ == '__main__':
+    print(f'Snapshot byl uložen zde: {build_snapshot(*sys.argv[1:2], force=True)}')
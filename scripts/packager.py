@@ -0,0 +1,104 @@
+import os
+import hashlib
+import zipfile
+import tempfile
+from scripts.metrics import METRICS
+
+DATA_DIR = 'municipalities_data'
+# PDF a obrázky jsou už komprimované, znovu je deflatovat jen stojí čas
+STORED_EXTENSIONS = ('.pdf', '.zip', '.png', '.jpg', '.jpeg', '.parquet')
+EXCLUDED_SUFFIXES = ('.part', '.meta.json', '.tmp')
+STREAM_BLOCK_SIZE = 1 << 20
+
+def zip_path_for(city_name: str, data_dir=DATA_DIR) -> str:
+    return os.path.join(data_dir, f'{city_name}.zip')
+
+def list_members(folder: str) -> list[tuple[str, str, os.stat_result]]:
+    members = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(EXCLUDED_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            members.append((os.path.relpath(path, folder).replace(os.sep, '/'), path, os.stat(path)))
+    return members
+
+def members_etag(members) -> str:
+    # stačí metadata souborů, obsah se nečte
+    h = hashlib.sha1()
+    for arcname, _, st in members:
+        h.update(f'{arcname}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+def _compression(arcname: str) -> int:
+    return zipfile.ZIP_STORED if arcname.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+
+def _write_members(zf: zipfile.ZipFile, members):
+    for arcname, path, st in members:
+        info = zipfile.ZipInfo.from_file(path, arcname)
+        info.compress_type = _compression(arcname)
+        with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+            for block in iter(lambda: src.read(STREAM_BLOCK_SIZE), b''):
+                dst.write(block)
+                yield
+
+def zip_etag(zip_path: str) -> str | None:
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            return zf.comment.decode() or None
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+@METRICS.timer('zip')
+def build_zip(city_name: str, data_dir=DATA_DIR) -> str:
+    '''Zabalí složku obce do ZIPu; pokud se žádný soubor nezměnil, nechá stávající archiv.'''
+    folder = os.path.join(data_dir, city_name)
+    zip_path = zip_path_for(city_name, data_dir)
+    members = list_members(folder)
+    etag = members_etag(members)
+    if zip_etag(zip_path) == etag:
+        return zip_path
+
+    fd, tmp_path = tempfile.mkstemp(dir=data_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f, zipfile.ZipFile(f, 'w') as zf:
+            for _ in _write_members(zf, members):
+                pass
+            zf.comment = etag.encode()
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return zip_path
+
+def zip_city_folder(city_name: str) -> str:
+    return build_zip(city_name)
+
+class _StreamBuffer:
+    # zipfile zapisuje do neseekovatelného proudu s datovými deskriptory
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data, self.parts = b''.join(self.parts), []
+        return data
+
+def stream_zip(city_name: str, data_dir=DATA_DIR):
+    '''Generuje ZIP přímo ze složky obce, bez mezisouboru na disku.'''
+    members = list_members(os.path.join(data_dir, city_name))
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for _ in _write_members(zf, members):
+            data = buffer.take()
+            if data:
+                yield data
+        zf.comment = members_etag(members).encode()
+    yield buffer.take()
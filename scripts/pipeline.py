@@ -0,0 +1,35 @@
+import time
+from scripts.downloader import download_plan
+from scripts.summarizer import analyze_issues_and_trends, generate_summary_txt
+from scripts.bigquery_updater import update_table
+from scripts.packager import zip_city_folder
+
+PIPELINE_STAGES = [
+    ('download', lambda city, api_key, on_progress: bool(download_plan(city))),
+    ('analyze', lambda city, api_key, on_progress: analyze_issues_and_trends(city, api_key, on_progress=on_progress)),
+    ('summary', lambda city, api_key, on_progress: generate_summary_txt(city, api_key)),
+    ('bigquery', lambda city, api_key, on_progress: update_table(city)),
+    ('zip', lambda city, api_key, on_progress: bool(zip_city_folder(city))),
+]
+
+class StageFailed(Exception):
+    def __init__(self, stage: str, timings: dict):
+        super().__init__(f'Krok "{stage}" selhal')
+        self.stage = stage
+        self.timings = timings
+
+def run_stages(city_name: str, api_key: str, on_stage=None, stages=None, on_progress=None) -> dict[str, float]:
+    # on_progress(stage, done, total) hlásí průběh uvnitř kroku, např. analyzované části plánu
+    timings = {}
+    for stage, fn in PIPELINE_STAGES:
+        if stages is not None and stage not in stages:
+            continue
+        if on_stage:
+            on_stage(stage)
+        start = time.perf_counter()
+        progress = (lambda done, total, stage=stage: on_progress(stage, done, total)) if on_progress else None
+        ok = fn(city_name, api_key, progress)
+        timings[stage] = round(time.perf_counter() - start, 3)
+        if not ok:
+            raise StageFailed(stage, timings)
+    return timings
@@ -0,0 +1,128 @@
+import os
+import re
+import time
+import sqlite3
+import argparse
+import threading
+import pandas as pd
+from scripts.municipality_index import get_index
+
+UUR_CSV = 'data_sources/uur_data.csv'
+PLAN_EVENTS_DB = os.getenv('PLAN_EVENTS_DB', 'cleansed_data/plan_events.sqlite')
+# vydání a nabytí účinnosti znamenají novou platnou verzi plánu
+CHANGE_ACTIONS = (116, 117)
+ACTION_CODE = re.compile(r'(\d{3})\s*$')
+
+def melt_uur(df: pd.DataFrame) -> pd.DataFrame:
+    '''Převede široký export ÚÚR na řádky událostí (obec, dokumentace, kód akce, datum) bez kódu obce.'''
+    df = df.copy()
+    # řádky změn mají prázdné "Obec" a název obce ve druhém sloupci
+    df['obec'] = df['Obec'].fillna(df['Unnamed: 1']).str.strip()
+    df = df.rename(columns={'Číslo dokumentace': 'document', 'Název dokumentace': 'document_name'})
+    actions = {col: int(m.group(1)) for col in df.columns if (m := ACTION_CODE.search(col))}
+
+    events = df.melt(id_vars=['obec', 'document', 'document_name'], value_vars=list(actions),
+                     var_name='action', value_name='date').dropna(subset=['date', 'obec'])
+    events['action'] = events['action'].map(actions)
+    events['date'] = pd.to_datetime(events['date'].str.strip(), format='%d.%m.%Y', errors='coerce')
+    events = events.dropna(subset=['date'])
+    events['date'] = events['date'].dt.strftime('%Y-%m-%d')
+    events['document_name'] = events['document_name'].str.strip()
+    return events.reset_index(drop=True)
+
+def parse_uur(csv_path=UUR_CSV) -> pd.DataFrame:
+    '''Události z exportu ÚÚR přiřazené ke kódům obcí podle názvu.'''
+    events = melt_uur(pd.read_csv(csv_path, dtype=str, encoding='utf-8-sig'))
+
+    # export zná jen název obce; nejednoznačný název se přiřadí všem obcím toho jména
+    index = get_index()
+    kods = {name: [r['municipality_kod'] for r in index.by_name(name)] or [None] for name in events['obec'].unique()}
+    events['municipality_kod'] = events['obec'].map(kods)
+    events = events.explode('municipality_kod')
+    events['municipality_kod'] = events['municipality_kod'].astype('Int64')
+    return events[['municipality_kod', 'obec', 'document', 'document_name', 'action', 'date']].reset_index(drop=True)
+
+class PlanEventStore:
+    '''Indexovaná tabulka událostí územních plánů v SQLite, obnovená při změně zdrojového CSV.'''
+
+    def __init__(self, path=PLAN_EVENTS_DB, csv_path=UUR_CSV):
+        self.path = path
+        self.csv_path = csv_path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS events (
+                    municipality_kod INTEGER,
+                    obec TEXT,
+                    document TEXT,
+                    document_name TEXT,
+                    action INTEGER,
+                    date TEXT
+                )''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS events_date ON events(date, action)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS events_kod_date ON events(municipality_kod, date)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS source (path TEXT PRIMARY KEY, mtime REAL, loaded REAL)')
+            self._conn.commit()
+        return self._conn
+
+    def refresh(self, force=False) -> int:
+        '''Znovu načte CSV, pokud se od posledního načtení změnilo; vrací počet událostí.'''
+        mtime = os.path.getmtime(self.csv_path)
+        with self._lock:
+            db = self._db()
+            row = db.execute('SELECT mtime FROM source WHERE path = ?', (self.csv_path,)).fetchone()
+            if row and row[0] == mtime and not force:
+                return db.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+            events = parse_uur(self.csv_path)
+            with db:
+                db.execute('DELETE FROM events')
+                db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)', [
+                    (None if pd.isna(kod) else int(kod), obec, document, name, int(action), date)
+                    for kod, obec, document, name, action, date in events.itertuples(index=False)
+                ])
+                db.execute('INSERT OR REPLACE INTO source VALUES (?, ?, ?)', (self.csv_path, mtime, time.time()))
+            return len(events)
+
+    def changed_since(self, since: str, until=None, actions=CHANGE_ACTIONS) -> pd.DataFrame:
+        '''Obce, jejichž plán se změnil od data since (včetně), s poslední událostí a dokumentací.'''
+        self.refresh()
+        conditions, params = ['date >= ?'], [str(since)]
+        if until:
+            conditions.append('date < ?')
+            params.append(str(until))
+        if actions:
+            conditions.append(f"action IN ({', '.join('?' * len(actions))})")
+            params.extend(actions)
+        with self._lock:
+            return pd.read_sql_query(f'''
+                SELECT municipality_kod, obec, MAX(date) AS last_change, COUNT(*) AS events,
+                       GROUP_CONCAT(DISTINCT document_name) AS documents
+                FROM events WHERE {' AND '.join(conditions)}
+                GROUP BY municipality_kod, obec ORDER BY last_change DESC''', self._db(), params=params)
+
+    def history(self, municipality_kod) -> pd.DataFrame:
+        self.refresh()
+        with self._lock:
+            return pd.read_sql_query('SELECT * FROM events WHERE municipality_kod = ? ORDER BY date',
+                                     self._db(), params=(int(municipality_kod),))
+
+PLAN_EVENTS = PlanEventStore()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Obce se změnou územního plánu podle exportu ÚÚR.')
+    parser.add_argument('since', help='Datum od (YYYY-MM-DD)')
+    parser.add_argument('--until', help='Datum do (YYYY-MM-DD, bez tohoto dne)')
+    parser.add_argument('--all-actions', action='store_true', help='Počítat i rozpracované kroky, nejen vydání')
+    args = parser.parse_args(argv)
+    changed = PLAN_EVENTS.changed_since(args.since, args.until, None if args.all_actions else CHANGE_ACTIONS)
+    print(changed.to_string(index=False))
+    print(f'\n{len(changed)} obcí se změnou od {args.since}')
+
+if __name__ == '__main__':
+    main()
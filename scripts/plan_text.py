@@ -0,0 +1,209 @@
+import os
+import json
+import re
+import tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import fitz
+import tiktoken
+from scripts.blob_store import file_sha256
+from scripts.metrics import METRICS, Stopwatch
+
+CHUNK_TOKEN_LIMIT = 1500
+ENCODER = tiktoken.get_encoding('cl100k_base')
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', 0))
+# konec stránky je preferovaná hranice, pokud je část zaplněna alespoň z této míry
+PAGE_BREAK_FILL = 0.75
+WORD_BOUNDARY_LOOKBACK = 64
+PARAGRAPH_BREAK = re.compile(r'\n\s*\n|(?<=[.:;])[ \t]*\n')
+PARAGRAPH_SEPARATOR = ENCODER.encode_ordinary('\n')
+DOCUMENT_CACHE_DIR = os.getenv('DOCUMENT_CACHE_DIR', 'cache/documents')
+DOCUMENT_VERSION = 4
+PAGE_BATCH_SIZE = 16
+PARALLEL_PAGE_THRESHOLD = int(os.getenv('PARALLEL_PAGE_THRESHOLD', 150))
+PDF_PROCESSES = int(os.getenv('PDF_PROCESSES', min(os.cpu_count() or 1, 4)))
+
+_process_pool = None
+
+class PlanReadError(Exception):
+    pass
+
+def _extract_page_range(pdf_path, start, stop):
+    with fitz.open(pdf_path) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
+
+def _get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        # spawn místo fork: proces webové aplikace už běží s vlákny
+        _process_pool = ProcessPoolExecutor(max_workers=PDF_PROCESSES,
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _process_pool
+
+def iter_pages(pdf_path, batch_size=PAGE_BATCH_SIZE, strict=False):
+    # strict: chyba čtení se vyhodí, aby se neúplný text neuložil jako hotový dokument
+    try:
+        with fitz.open(pdf_path) as doc:
+            page_count = doc.page_count
+            if page_count < PARALLEL_PAGE_THRESHOLD or PDF_PROCESSES <= 1:
+                for page in doc:
+                    yield page.get_text()
+                return
+
+        pool = _get_process_pool()
+        pending = deque()
+        for start in range(0, page_count, batch_size):
+            stop = min(start + batch_size, page_count)
+            pending.append(pool.submit(_extract_page_range, pdf_path, start, stop))
+            if len(pending) >= PDF_PROCESSES * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    except Exception as e:
+        if strict:
+            raise PlanReadError(f'pdf soubor nelze přečíst: {e}') from e
+        print(f'pdf soubor nelze přečíst: {e}')
+
+def extract_pages(pdf_path):
+    return list(iter_pages(pdf_path))
+
+def _paragraphs(page):
+    for paragraph in PARAGRAPH_BREAK.split(page):
+        paragraph = ' '.join(paragraph.split())
+        if paragraph:
+            yield paragraph
+
+def _word_boundary(tokens, limit):
+    # řez posuneme na začátek slova, aby se nerozdělilo slovo ani vícebajtový znak
+    for cut in range(limit, max(limit - WORD_BOUNDARY_LOOKBACK, 1), -1):
+        if ENCODER.decode_single_token_bytes(tokens[cut])[:1].isspace():
+            return cut
+    return limit
+
+def _tail(tokens, overlap):
+    if overlap <= 0 or not tokens:
+        return []
+    start = max(len(tokens) - overlap, 0)
+    while start < len(tokens) and not ENCODER.decode_single_token_bytes(tokens[start])[:1].isspace():
+        start += 1
+    return tokens[start:]
+
+def iter_chunks(pages, max_tokens=CHUNK_TOKEN_LIMIT, overlap=0):
+    if not 0 <= overlap <= max_tokens // 2:
+        raise ValueError('overlap musí být mezi 0 a polovinou max_tokens')
+
+    current, carried = [], 0
+    for page in pages:
+        paragraphs = list(_paragraphs(page))
+        if not paragraphs:
+            continue
+        for tokens in ENCODER.encode_ordinary_batch(paragraphs):
+            separator = PARAGRAPH_SEPARATOR if current else []
+            if len(current) > carried and len(current) + len(separator) + len(tokens) > max_tokens:
+                yield ENCODER.decode(current).strip()
+                current = _tail(current, overlap)
+                carried = len(current)
+                separator = PARAGRAPH_SEPARATOR if current else []
+            current = current + separator + tokens
+            while len(current) > max_tokens:
+                cut = _word_boundary(current, max_tokens)
+                yield ENCODER.decode(current[:cut]).strip()
+                head = _tail(current[:cut], overlap)
+                current = head + current[cut:]
+                carried = len(head)
+        if len(current) >= PAGE_BREAK_FILL * max_tokens:
+            yield ENCODER.decode(current).strip()
+            current = _tail(current, overlap)
+            carried = len(current)
+
+    if len(current) > carried:
+        yield ENCODER.decode(current).strip()
+
+def split_pages_into_chunks(pages, max_tokens=CHUNK_TOKEN_LIMIT, overlap=0):
+    return list(iter_chunks(pages, max_tokens, overlap))
+
+def split_text_into_chunks(text, max_tokens=CHUNK_TOKEN_LIMIT, overlap=0):
+    return split_pages_into_chunks([text], max_tokens, overlap)
+
+def _artifact_path(sha256, max_tokens, overlap, cache_dir):
+    return os.path.join(cache_dir, f'{sha256}_{max_tokens}_{overlap}.jsonl')
+
+def _artifact_version(artifact_path):
+    try:
+        with open(artifact_path, encoding='utf-8') as f:
+            return json.loads(f.readline()).get('version')
+    except (OSError, ValueError):
+        return None
+
+def _artifact_chunk_count(artifact_path):
+    try:
+        with open(artifact_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 256, 0))
+            return json.loads(f.read().splitlines()[-1]).get('chunks')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def _iter_artifact_chunks(artifact_path):
+    with open(artifact_path, encoding='utf-8') as f:
+        if json.loads(f.readline()).get('version') != DOCUMENT_VERSION:
+            raise ValueError(f'zastaralá verze dokumentu {artifact_path}')
+        for line in f:
+            record = json.loads(line)
+            if 'chunk' in record:
+                yield record['text']
+
+def _build_artifact(pdf_path, sha256, max_tokens, overlap, cache_dir):
+    # stránky i části se zapisují průběžně, takže v paměti není celý dokument
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    complete, chunk_count = False, 0
+    # čtení PDF a dělení na části se prolínají, čas chunkování je bez času extrakce
+    extraction, chunking = Stopwatch(), Stopwatch()
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            header = {'version': DOCUMENT_VERSION, 'sha256': sha256, 'max_tokens': max_tokens, 'overlap': overlap}
+            f.write(json.dumps(header) + '\n')
+
+            def pages():
+                offset = 0
+                for index, page in enumerate(extraction.iterate(iter_pages(pdf_path, strict=True))):
+                    f.write(json.dumps({'page': index, 'offset': offset, 'text': page}, ensure_ascii=False) + '\n')
+                    offset += len(page) + 1
+                    yield page
+
+            for chunk in chunking.iterate(iter_chunks(pages(), max_tokens, overlap)):
+                f.write(json.dumps({'chunk': chunk_count, 'text': chunk}, ensure_ascii=False) + '\n')
+                chunk_count += 1
+                yield chunk
+            # počet částí na konci souboru, aby ho šlo zjistit bez čtení celého dokumentu
+            f.write(json.dumps({'chunks': chunk_count}) + '\n')
+        complete = True
+        METRICS.observe('pdf_extract', extraction.seconds)
+        METRICS.observe('chunking', chunking.seconds - extraction.seconds)
+    finally:
+        if complete and chunk_count:
+            os.replace(tmp_path, _artifact_path(sha256, max_tokens, overlap, cache_dir))
+        else:
+            os.remove(tmp_path)
+
+def iter_plan_chunks(pdf_path: str, max_tokens=CHUNK_TOKEN_LIMIT, overlap=CHUNK_OVERLAP,
+                     cache_dir=DOCUMENT_CACHE_DIR, sha256=None):
+    sha256 = sha256 or file_sha256(pdf_path)
+    artifact_path = _artifact_path(sha256, max_tokens, overlap, cache_dir)
+    current = os.path.exists(artifact_path) and _artifact_version(artifact_path) == DOCUMENT_VERSION
+    METRICS.cache_lookup('documents', current)
+    if current:
+        yield from _iter_artifact_chunks(artifact_path)
+    else:
+        yield from _build_artifact(pdf_path, sha256, max_tokens, overlap, cache_dir)
+
+def plan_chunk_count(pdf_path: str, max_tokens=CHUNK_TOKEN_LIMIT, overlap=CHUNK_OVERLAP,
+                     cache_dir=DOCUMENT_CACHE_DIR, sha256=None) -> int | None:
+    '''Počet částí uloženého dokumentu; None, dokud plán nebyl poprvé rozdělen.'''
+    sha256 = sha256 or file_sha256(pdf_path)
+    artifact_path = _artifact_path(sha256, max_tokens, overlap, cache_dir)
+    if _artifact_version(artifact_path) != DOCUMENT_VERSION:
+        return None
+    return _artifact_chunk_count(artifact_path)
@@ -0,0 +1,111 @@
+import os
+import time
+import asyncio
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import pandas as pd
+from scripts.downloader import PLAN_CORPUS_DIR, corpus_path, fetch_file, store_download
+from scripts.municipality_index import get_index
+
+LINKS_DATA_CSV = 'data_sources/links_data.csv'
+MUNICIPALITY_CODES_CSV = 'data_sources/municipality_codes.csv'
+TEXT_PART_TYPE = 'Textová část'
+PER_HOST_LIMIT = int(os.getenv('PREFETCH_PER_HOST', 2))
+TOTAL_LIMIT = int(os.getenv('PREFETCH_TOTAL', 16))
+
+def resolve_documents(municipality_kods=None, formats=('application/pdf',),
+                      links_csv=LINKS_DATA_CSV, codes_csv=MUNICIPALITY_CODES_CSV) -> pd.DataFrame:
+    links = pd.read_csv(links_csv, usecols=['up_record_id', 'name', 'type', 'format', 'doc_order', 'url', 'is_full'])
+    codes = pd.read_csv(codes_csv, dtype={'municipality_kod': 'Int64'})
+    docs = links[links['type'] == TEXT_PART_TYPE]
+    if formats:
+        docs = docs[docs['format'].isin(formats)]
+    docs = docs.merge(codes, on='up_record_id')
+    if municipality_kods is not None:
+        docs = docs[docs['municipality_kod'].isin([int(k) for k in municipality_kods])]
+
+    docs = docs.assign(url=docs['url'].str.strip('{}'))
+    docs = docs.drop_duplicates('url')
+    docs['host'] = docs['url'].map(lambda u: urlsplit(u).netloc)
+    docs['path'] = docs['url'].map(corpus_path)
+    return docs.sort_values(['municipality_kod', 'up_record_id', 'doc_order']).reset_index(drop=True)
+
+def _host_stats():
+    return {'files': 0, 'not_modified': 0, 'failed': 0, 'bytes': 0, 'first': None, 'last': None, 'errors': []}
+
+async def _prefetch(docs: pd.DataFrame, per_host: int, total: int) -> dict:
+    host_limits = defaultdict(lambda: asyncio.Semaphore(per_host))
+    total_limit = asyncio.Semaphore(total)
+    stats = defaultdict(_host_stats)
+    loop = asyncio.get_running_loop()
+    # vlastní pool: výchozí executor asyncio má min(32, cpu + 4) vláken a tiše by omezil total
+    pool = ThreadPoolExecutor(max_workers=total, thread_name_prefix='prefetch')
+
+    async def fetch(url, host, path):
+        # nejdřív limit hostitele, aby čekání na jeden kraj neblokovalo sloty ostatním
+        async with host_limits[host], total_limit:
+            s = stats[host]
+            s['first'] = s['first'] or time.perf_counter()
+            try:
+                changed = await loop.run_in_executor(pool, fetch_file, url, path)
+                await loop.run_in_executor(pool, store_download, path)
+                if changed:
+                    s['files'] += 1
+                    s['bytes'] += os.path.getsize(path)
+                else:
+                    s['not_modified'] += 1
+            except Exception as e:
+                s['failed'] += 1
+                s['errors'].append(f'{url}: {e}')
+            s['last'] = time.perf_counter()
+
+    os.makedirs(PLAN_CORPUS_DIR, exist_ok=True)
+    with pool:
+        await asyncio.gather(*(fetch(d.url, d.host, d.path) for d in docs.itertuples()))
+    return stats
+
+def prefetch(municipality_kods=None, per_host=PER_HOST_LIMIT, total=TOTAL_LIMIT) -> dict:
+    docs = resolve_documents(municipality_kods)
+    start = time.perf_counter()
+    stats = asyncio.run(_prefetch(docs, per_host, total))
+    elapsed = time.perf_counter() - start
+
+    hosts = {}
+    for host, s in sorted(stats.items()):
+        active = (s['last'] - s['first']) if s['first'] else 0.0
+        hosts[host] = {
+            'files': s['files'],
+            'not_modified': s['not_modified'],
+            'failed': s['failed'],
+            'megabytes': s['bytes'] / 1e6,
+            'mb_per_second': s['bytes'] / 1e6 / active if active else 0.0,
+            'errors': s['errors'],
+        }
+    return {'documents': len(docs), 'elapsed_seconds': elapsed, 'hosts': hosts}
+
+def print_report(report: dict) -> None:
+    print(f"\nZpracováno {report['documents']} dokumentů za {report['elapsed_seconds']:.1f} s")
+    for host, h in report['hosts'].items():
+        print(f"  {host:<34} staženo={h['files']:<5} beze změny={h['not_modified']:<5} chyby={h['failed']:<4} "
+              f"{h['megabytes']:.1f} MB, {h['mb_per_second']:.2f} MB/s")
+        for error in h['errors'][:3]:
+            print(f'    {error}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Hromadné předstažení textových částí územních plánů.')
+    parser.add_argument('cities', nargs='*', default=['all'], help='Názvy nebo kódy obcí, případně "all"')
+    parser.add_argument('--per-host', type=int, default=PER_HOST_LIMIT, help='Souběžná spojení na jeden geoportál')
+    parser.add_argument('--total', type=int, default=TOTAL_LIMIT, help='Souběžná stahování celkem')
+    args = parser.parse_args(argv)
+
+    kods = None
+    if args.cities != ['all']:
+        index = get_index()
+        kods = [row['municipality_kod'] for city in args.cities for row in
+                ([index.by_kod(city)] if city.isdigit() and index.by_kod(city) else index.by_name(city))]
+    print_report(prefetch(kods, args.per_host, args.total))
+
+if __name__ == '__main__':
+    main()
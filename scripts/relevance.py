@@ -0,0 +1,85 @@
+import os
+import re
+import math
+from collections import Counter
+from scripts.municipality_index import normalize_name
+from scripts.plan_text import ENCODER
+
+# Předvýběr musí ohodnotit celý dokument, než se odešle první dotaz na LLM, takže při prvním čtení
+# plánu se analýza nepřekrývá s parsováním PDF. Úspora dotazů je větší než ztráta souběhu;
+# RELEVANCE_FILTER=0 vrátí průběžné předávání částí do analýzy.
+RELEVANCE_FILTER = os.getenv('RELEVANCE_FILTER', '1') != '0'
+ANALYSIS_TOKEN_BUDGET = int(os.getenv('ANALYSIS_TOKEN_BUDGET', 60000))
+SUMMARY_TOKEN_BUDGET = int(os.getenv('SUMMARY_TOKEN_BUDGET', 24000))
+MIN_RELEVANCE = float(os.getenv('MIN_RELEVANCE', 0.0))
+MIN_RELEVANT_CHUNKS = int(os.getenv('MIN_RELEVANT_CHUNKS', 3))
+
+# kmeny slov bez diakritiky; porovnává se začátek slova
+PLANNING_STEMS = (
+    'rozvoj', 'koncepc', 'zastav', 'urbanis', 'bydlen', 'obyvatel', 'sidl', 'struktur', 'charakter',
+    'krajin', 'zelen', 'prirod', 'zemedel', 'les', 'vod', 'zaplav', 'eroz', 'uses', 'biokoridor', 'biocentr',
+    'doprav', 'silnic', 'zeleznic', 'cyklo', 'parkov', 'infrastruktur', 'vodovod', 'kanalizac', 'energ',
+    'obcansk', 'vybaven', 'verejn', 'prostranstv', 'rekreac', 'turis', 'sport', 'skol', 'sluzb',
+    'vyrob', 'prumysl', 'podnik', 'brownfield', 'prestavb', 'transformac', 'stabiliz', 'rezerv',
+    'pamat', 'kultur', 'hodnot', 'ochran', 'problem', 'rizik', 'zamer', 'strateg', 'potencial',
+)
+# právní a formální text, legendy a výčty parcel
+BOILERPLATE_STEMS = (
+    'vyhlas', 'zakon', 'sb', 'odst', 'pism', 'paragraf', 'ustanov', 'usnesen', 'poucen', 'ucinnost',
+    'opatreni', 'obecne', 'zastupitelstv', 'parc', 'kat', 'legend', 'vykres', 'priloh', 'tabulk',
+)
+WORD = re.compile(r'\w+')
+
+def _words(text: str) -> list[str]:
+    return WORD.findall(normalize_name(text))
+
+def _source(chunks):
+    # seznam, nebo funkce vracející při každém volání nový průchod částmi (např. z uloženého dokumentu)
+    return chunks if callable(chunks) else (lambda: iter(chunks))
+
+def _scores_and_sizes(source) -> tuple[list[float], list[int]]:
+    df, count = Counter(), 0
+    for chunk in source():
+        df.update(set(_words(chunk)))
+        count += 1
+    log_n = math.log(count + 1)
+    scores, sizes = [], []
+    for chunk in source():
+        words = _words(chunk)
+        n = len(words) or 1
+        planning = sum(1 for w in words if w.startswith(PLANNING_STEMS)) / n
+        boilerplate = (sum(1 for w in words if w.startswith(BOILERPLATE_STEMS)) + chunk.count('§')) / n
+        numeric = sum(1 for w in words if w.isdigit()) / n
+        # slova opakovaná ve všech částech (hlavičky, právní formulace) mají nízké idf
+        distinct = sum(math.log((count + 1) / df[w]) for w in set(words)) / (n * log_n) if log_n else 0.0
+        scores.append(10 * planning + distinct - 5 * boilerplate - 2 * numeric)
+        sizes.append(len(ENCODER.encode_ordinary(chunk)))
+    return scores, sizes
+
+def score_chunks(chunks) -> list[float]:
+    '''Levné skóre informativnosti části: slovník územního plánování, TF-IDF a penalizace formálního textu.'''
+    return _scores_and_sizes(_source(chunks))[0]
+
+def select_chunks(chunks, token_budget: int, min_score=MIN_RELEVANCE,
+                  min_chunks=MIN_RELEVANT_CHUNKS) -> tuple[list[str], dict]:
+    '''Vybere nejinformativnější části do rozpočtu tokenů; vrací je v původním pořadí spolu s přehledem.
+    Části se procházejí opakovaně a v paměti zůstávají jen skóre a vybrané části.'''
+    source = _source(chunks)
+    scores, sizes = _scores_and_sizes(source)
+    kept, tokens = set(), 0
+    for rank, i in enumerate(sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)):
+        # nejlepších min_chunks částí zůstává i pod prahem, plán plný tabulek nesmí přijít o vše
+        if rank >= min_chunks and scores[i] < min_score:
+            break
+        if kept and tokens + sizes[i] > token_budget:
+            continue
+        kept.add(i)
+        tokens += sizes[i]
+    report = {
+        'chunks': len(scores),
+        'kept': len(kept),
+        'dropped': len(scores) - len(kept),
+        'tokens': sum(sizes),
+        'tokens_kept': tokens,
+    }
+    return [chunk for i, chunk in enumerate(source()) if i in kept], report
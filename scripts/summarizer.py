@@ -1,62 +1,161 @@
 import os
-import fitz
-import tiktoken
+import json
+import hashlib
+import threading
+import contextvars
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from openai import OpenAI
 from utils import chunk_prompt, analysis_prompt, summary_prompt
+from scripts.llm_cache import LLM_CACHE, CACHE_DISABLED, cache_key
+from scripts.plan_text import CHUNK_OVERLAP, CHUNK_TOKEN_LIMIT, ENCODER, PlanReadError, iter_plan_chunks, plan_chunk_count
+from scripts.municipality_index import MUNICIPALITIES_CSV, resolve_municipality
+from scripts.enrichment_store import ENRICHMENT_STORE
+from scripts.blob_store import file_sha256
+from scripts.metrics import METRICS
+from scripts.chunk_index import CHUNK_INDEX, DEDUP_DISABLED, DedupStats, signature
+from scripts.relevance import (RELEVANCE_FILTER, ANALYSIS_TOKEN_BUDGET, SUMMARY_TOKEN_BUDGET, MIN_RELEVANCE,
+                               MIN_RELEVANT_CHUNKS, select_chunks)
 
 CHUNK_MODEL = 'gpt-3.5-turbo'
 SUMMARY_MODEL = 'o4-mini'
-CHUNK_TOKEN_LIMIT = 1500
-ENCODER = tiktoken.encoding_for_model(CHUNK_MODEL)
+CHUNK_CONCURRENCY = int(os.getenv('CHUNK_CONCURRENCY', 8))
+SYSTEM_MESSAGE = 'Jsi asistent v oblasti územního plánování.'
+PLAN_RESULTS_DIR = os.getenv('PLAN_RESULTS_DIR', 'cache/plan_results')
+# výstupy částí poslední analyzované verze plánu každé obce, pro inkrementální přepočet
+PLAN_STATE_DIR = os.getenv('PLAN_STATE_DIR', 'cache/plan_state')
+INCREMENTAL_ANALYSIS = os.getenv('INCREMENTAL_ANALYSIS', '1') != '0'
+# nad tímto rozsahem se výstupy částí slučují po skupinách, než dojde na finální souhrn
+REDUCE_TOKEN_BUDGET = int(os.getenv('REDUCE_TOKEN_BUDGET', 8000))
+SUMMARY_MAX_CHUNKS = 50
+CHUNK_VARIANT = cache_key(CHUNK_MODEL, SYSTEM_MESSAGE, chunk_prompt)[:12]
+# nastavení, která mění výsledek, jsou součástí klíče uložených výsledků plánu
+CHUNKING_VARIANT = f'{CHUNK_TOKEN_LIMIT}|{CHUNK_OVERLAP}'
+ANALYSIS_VARIANT = (f'{CHUNKING_VARIANT}|{REDUCE_TOKEN_BUDGET}|{RELEVANCE_FILTER}|{ANALYSIS_TOKEN_BUDGET}'
+                    f'|{MIN_RELEVANCE}|{MIN_RELEVANT_CHUNKS}')
+SUMMARY_VARIANT = (f'{CHUNKING_VARIANT}|{RELEVANCE_FILTER}|{SUMMARY_TOKEN_BUDGET}|{MIN_RELEVANCE}'
+                   f'|{MIN_RELEVANT_CHUNKS}')
 
-def extract_text_from_pdf(pdf_path):
+def gpt_call(prompt, model, client, use_cache=not CACHE_DISABLED):
+    key = cache_key(model, SYSTEM_MESSAGE, prompt)
+    if use_cache:
+        cached = LLM_CACHE.get(key)
+        METRICS.cache_lookup('llm', cached is not None)
+        if cached is not None:
+            return cached
     try:
-        doc = fitz.open(pdf_path)
-        return '\\n'.join(page.get_text() for page in doc)
-    except Exception as e:
-        print(f'pdf soubor nelze přečíst: {e}')
-        return ''
-
-def split_text_into_chunks(text, max_tokens=CHUNK_TOKEN_LIMIT):
-    words = text.split()
-    chunks, chunk, tokens = [], [], 0
-    for word in words:
-        t = len(ENCODER.encode(word))
-        if tokens + t > max_tokens:
-            chunks.append(' '.join(chunk))
-            chunk, tokens = [word], t
-        else:
-            chunk.append(word)
-            tokens += t
-    if chunk:
-        chunks.append(' '.join(chunk))
-    return chunks
-
-def gpt_call(prompt, model, client):
-    try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {'role': 'system', 'content': 'Jsi asistent v oblasti územního plánování.'},
-                {'role': 'user', 'content': prompt}
-            ],
-        )
-        return response.choices[0].message.content.strip()
+        with METRICS.timer('llm_call', model):
+            response = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {'role': 'system', 'content': SYSTEM_MESSAGE},
+                    {'role': 'user', 'content': prompt}
+                ],
+            )
+        METRICS.record_usage(model, response.usage)
+        content = response.choices[0].message.content.strip()
     except Exception as e:
         print(f'Funkce gpt_call selhala: {e}')
         return ''
+    if use_cache and content:
+        LLM_CACHE.put(key, model, content)
+    return content
 
-def analyze_chunk(chunk_text, client):
+def analyze_chunk(chunk_text, client, dedup=None):
+    # téměř shodná část (šablona, změna plánu) převezme analýzu z dříve zpracovaného plánu
+    sig = None if DEDUP_DISABLED else signature(chunk_text)
+    if sig is not None:
+        reused = CHUNK_INDEX.find(sig, CHUNK_VARIANT)
+        if reused is not None:
+            METRICS.count('dedup_chunks', result='reused')
+            if dedup:
+                dedup.record(True)
+            return reused
     prompt = chunk_prompt
     prompt += f"\\n'''\\n{chunk_text}\\n'''"
-    return gpt_call(prompt, model=CHUNK_MODEL, client=client)
+    content = gpt_call(prompt, model=CHUNK_MODEL, client=client)
+    if sig is not None and content:
+        CHUNK_INDEX.add(sig, CHUNK_VARIANT, content)
+    METRICS.count('dedup_chunks', result='analysed')
+    if dedup:
+        dedup.record(False)
+    return content
+
+def analyze_chunks(chunks, client, max_workers=CHUNK_CONCURRENCY, on_progress=None, dedup=None, total=None):
+    # chunks může být generátor, který teprve čte PDF; dotazy se odesílají průběžně
+    # a v paměti čeká nejvýše 2 * max_workers rozpracovaných částí
+    if total is None and hasattr(chunks, '__len__'):
+        total = len(chunks)
+    results = []
+    if on_progress:
+        on_progress(0, total)
+
+    def collect(result):
+        results.append(result)
+        if on_progress:
+            on_progress(len(results), total)
+
+    if max_workers <= 1:
+        for chunk in chunks:
+            collect(analyze_chunk(chunk, client, dedup))
+        return results
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for chunk in chunks:
+            # kontext nese obec, na kterou se připisují náklady volání
+            pending.append(pool.submit(contextvars.copy_context().run, analyze_chunk, chunk, client, dedup))
+            if len(pending) >= max_workers * 2:
+                collect(pending.popleft().result())
+        for future in pending:
+            collect(future.result())
+    # výsledky jsou v pořadí částí, takže vstup pro souhrn je deterministický
+    return results
 
 def summarize_issues_and_trends(all_responses, client):
     prompt = analysis_prompt
     prompt += f"\\n'''\\n{all_responses}\\n'''"
     return gpt_call(prompt, model=SUMMARY_MODEL, client=client)
 
+def _truncate(responses, limit):
+    # každá odpověď nejvýš limit tokenů, aby žádný dotaz nepřekročil rozpočet
+    return [ENCODER.decode(tokens[:limit]) if len(tokens) > limit else response
+            for response, tokens in zip(responses, ENCODER.encode_ordinary_batch(responses))]
+
+def _group_by_budget(responses, budget):
+    groups, current, tokens = [], [], 0
+    responses = _truncate(responses, budget)
+    for response, size in zip(responses, (len(t) for t in ENCODER.encode_ordinary_batch(responses))):
+        if current and tokens + size > budget:
+            groups.append(current)
+            current, tokens = [], 0
+        current.append(response)
+        tokens += size
+    if current:
+        groups.append(current)
+    return groups
+
+def reduce_responses(responses, client, max_workers=CHUNK_CONCURRENCY, budget=REDUCE_TOKEN_BUDGET):
+    # stromová redukce: skupiny do velikosti rozpočtu se shrnují paralelně, dokud se vše nevejde
+    # do jednoho dotazu, takže finální souhrn nezávisí na délce plánu
+    groups = _group_by_budget(responses, budget)
+    while len(groups) > 1:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as pool:
+            futures = [pool.submit(contextvars.copy_context().run, summarize_issues_and_trends,
+                                   '\\n\\n'.join(group), client) for group in groups]
+            partial = [future.result() for future in futures]
+        partial = [p for p in partial if p]
+        if not partial:
+            return ''
+        next_groups = _group_by_budget(partial, budget)
+        if len(next_groups) >= len(groups):
+            # shrnutí skupin se už nezmenšují; zbytek se sloučí najednou, každé zkrácené na svůj díl
+            # rozpočtu s rezervou na oddělovače
+            next_groups = [_truncate(partial, max(1, budget // len(partial) - 2))]
+        groups = next_groups
+    return summarize_issues_and_trends('\\n\\n'.join(groups[0]) if groups else '', client)
+
 def parse_summary(summary_text):
     lines = summary_text.strip().splitlines()
     problems, trends = [], []
@@ -73,7 +172,100 @@ def parse_summary(summary_text):
             current.append(line.lstrip('- ').strip())
     return problems[:5], trends[:5]
 
-def analyze_issues_and_trends(city_name: str, api_key: str, csv_path='cleansed_data/municipalities.csv') -> bool:
+def _plan_result_path(sha256, kind, model, prompt):
+    # výsledek závisí i na modelu a promptu, jejich změna ho zneplatní
+    variant = cache_key(model, SYSTEM_MESSAGE, prompt)[:12]
+    return os.path.join(PLAN_RESULTS_DIR, f'{sha256}_{kind}_{variant}.json')
+
+def load_plan_result(sha256, kind, model, prompt):
+    path = _plan_result_path(sha256, kind, model, prompt)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_json(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def save_plan_result(sha256, kind, model, prompt, value):
+    _write_json(_plan_result_path(sha256, kind, model, prompt), value)
+
+def _text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def _plan_state_path(municipality_kod):
+    return os.path.join(PLAN_STATE_DIR, f'{int(municipality_kod)}.json')
+
+def load_plan_state(municipality_kod):
+    path = _plan_state_path(municipality_kod)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        state = json.load(f)
+    return state if state.get('variant') == CHUNK_VARIANT else None
+
+def analyze_incrementally(municipality_kod, sha256, chunks, client, max_workers=CHUNK_CONCURRENCY,
+                          on_progress=None, dedup=None, total=None):
+    '''Znovu analyzuje jen části, které v předchozí verzi plánu obce nebyly; ostatní výstupy převezme.'''
+    previous = load_plan_state(municipality_kod) or {'sha256': None, 'chunks': {}}
+    hashes, todo, queued = [], [], set()
+    if total is None and hasattr(chunks, '__len__'):
+        total = len(chunks)
+    progress = None
+    if on_progress:
+        # převzaté části se hlásí jako hotové, total jsou všechny části plánu
+        progress = lambda done, _: on_progress(len(hashes) - len(todo) + done, total)
+
+    def new_chunks():
+        # části se hashují průběžně, v paměti zůstávají jen hashe a výstupy
+        for chunk in chunks:
+            h = _text_hash(chunk)
+            hashes.append(h)
+            if h not in previous['chunks'] and h not in queued:
+                queued.add(h)
+                todo.append(h)
+                yield chunk
+
+    source = list(new_chunks()) if hasattr(chunks, '__len__') else new_chunks()
+    fresh = analyze_chunks(source, client, max_workers, progress, dedup)
+    fresh = dict(zip(todo, fresh))
+    if on_progress:
+        on_progress(len(hashes), total or len(hashes))
+    results = [previous['chunks'].get(h, fresh.get(h)) for h in hashes]
+
+    if previous['sha256'] and previous['sha256'] != sha256:
+        print(f'Inkrementální analýza: oproti předchozí verzi znovu analyzováno {len(todo)}/{len(hashes)} částí')
+    METRICS.count('incremental_chunks', len(hashes) - len(todo), result='reused')
+    METRICS.count('incremental_chunks', len(todo), result='analysed')
+
+    if any(results):
+        _write_json(_plan_state_path(municipality_kod), {
+            'sha256': sha256,
+            'variant': CHUNK_VARIANT,
+            'chunks': {h: r for h, r in zip(hashes, results) if r},
+        })
+    return results
+
+def relevant_chunks(pdf_path, sha256, token_budget, purpose):
+    # lokální předvýběr: do LLM jdou jen nejinformativnější části v rámci rozpočtu tokenů;
+    # části se čtou v několika průchodech z uloženého dokumentu, celý plán v paměti není,
+    # ale první dotaz odchází až po přečtení celého plánu (viz RELEVANCE_FILTER)
+    selected, report = select_chunks(lambda: iter_plan_chunks(pdf_path, sha256=sha256), token_budget)
+    METRICS.count('relevance_chunks', report['kept'], purpose=purpose, result='kept')
+    METRICS.count('relevance_chunks', report['dropped'], purpose=purpose, result='dropped')
+    print(f"Předvýběr ({purpose}): ponecháno {report['kept']}/{report['chunks']} částí, "
+          f"vynecháno {report['dropped']} ({report['tokens_kept']}/{report['tokens']} tokenů)")
+    if report['chunks'] and not selected:
+        print(f'Předvýběr ({purpose}) vyřadil všechny části plánu; zkontrolujte MIN_RELEVANCE a MIN_RELEVANT_CHUNKS.')
+    return selected, report
+
+def analyze_issues_and_trends(city_name: str, api_key: str, csv_path=MUNICIPALITIES_CSV,
+                              max_workers=CHUNK_CONCURRENCY, kraj=None, okres=None, on_progress=None,
+                              incremental=INCREMENTAL_ANALYSIS) -> bool:
     client = OpenAI(api_key=api_key)
 
     folder = f'municipalities_data/{city_name}'
@@ -84,48 +276,63 @@ def analyze_issues_and_trends(city_name: str, api_key: str, csv_path='cleansed_d
         print(f'pdf soubor nebyl nalezen: {pdf_path}')
         return False
 
-    full_text = extract_text_from_pdf(pdf_path)
-    if not full_text:
-        print('Z pdf souboru nebyl extrahován žádný text.')
-        return False
-
-    chunks = split_text_into_chunks(full_text)
-    if not chunks:
-        print('Nebyly vytvořeny žádné části textu.')
-        return False
-
-    responses = []
-    for chunk in chunks:
-        result = analyze_chunk(chunk, client)
-        if result:
-            responses.append(result)
-
-    combined = '\\n\\n'.join(responses)
-    summary = summarize_issues_and_trends(combined, client)
-    problems, trends = parse_summary(summary)
-
-    df = pd.read_csv(csv_path)
-    mask = df['obec'].str.lower() == city_name.lower()
-
-    if not mask.any():
+    municipality = resolve_municipality(city_name, kraj, okres, csv_path)
+    if municipality is None:
         print(f'Obec "{city_name}" nebyla nalezena v csv souboru.')
         return False
 
-    for i in range(5):
-        column_p = f'problem_{i+1}'
-        column_t = f'trend_{i+1}'
+    # stejný plán (i u jiné obce) se nepočítá znovu
+    sha256 = file_sha256(pdf_path)
+    cached = load_plan_result(sha256, 'analysis', CHUNK_MODEL + SUMMARY_MODEL,
+                              chunk_prompt + analysis_prompt + ANALYSIS_VARIANT)
+    METRICS.cache_lookup('plan_results', bool(cached))
+    if cached:
+        problems, trends = cached['problems'], cached['trends']
+    else:
+        try:
+            chunks, total = iter_plan_chunks(pdf_path, sha256=sha256), None
+            if RELEVANCE_FILTER:
+                chunks, report = relevant_chunks(pdf_path, sha256, ANALYSIS_TOKEN_BUDGET, 'analysis')
+                if report['chunks'] and not chunks:
+                    return False
+                total = len(chunks)
+            elif on_progress:
+                # pro hlášení "část 37/120" stačí počet z uloženého dokumentu, při prvním čtení není znám
+                total = plan_chunk_count(pdf_path, sha256=sha256)
+            dedup = DedupStats()
+            with METRICS.city(city_name):
+                if incremental:
+                    results = analyze_incrementally(municipality['municipality_kod'], sha256, chunks, client,
+                                                    max_workers, on_progress, dedup, total)
+                else:
+                    results = analyze_chunks(chunks, client, max_workers, on_progress, dedup, total)
+                if not results:
+                    print('Z pdf souboru nebyl extrahován žádný text.')
+                    return False
+                if not DEDUP_DISABLED:
+                    corpus = CHUNK_INDEX.stats()
+                    print(f'Deduplikace: převzato {dedup.reused}/{dedup.reused + dedup.analysed} částí '
+                          f'({dedup.ratio:.0%}), v celém korpusu {corpus["dedup_ratio"]:.0%} z {corpus["entries"]} uložených')
 
-        df.loc[mask, column_p] = problems[i] if i < len(problems) else ''
-        df.loc[mask, column_t] = trends[i] if i < len(trends) else ''
+                responses = [r for r in results if r]
 
-    df.to_csv(csv_path, index=False, encoding='utf-8-sig')
+                summary = reduce_responses(responses, client, max_workers)
+        except PlanReadError as e:
+            print(e)
+            return False
+        problems, trends = parse_summary(summary)
+        if problems or trends:
+            save_plan_result(sha256, 'analysis', CHUNK_MODEL + SUMMARY_MODEL,
+                             chunk_prompt + analysis_prompt + ANALYSIS_VARIANT,
+                             {'problems': problems, 'trends': trends})
+
+    values = ENRICHMENT_STORE.upsert(municipality['municipality_kod'], municipality['obec'], problems, trends)
     os.makedirs(folder, exist_ok=True)
-    df[mask].to_csv(output_path, index=False, encoding='utf-8-sig')
+    pd.DataFrame([{**municipality, **values}]).to_csv(output_path, index=False, encoding='utf-8-sig')
     print(f'Trendy a problémy jsou uložené zde: {output_path}')
     return True
 
 def generate_summary_txt(city_name: str, api_key: str) -> bool:
-    from openai import OpenAI
     client = OpenAI(api_key=api_key)
 
     folder = f'municipalities_data/{city_name}'
@@ -136,20 +343,32 @@ def generate_summary_txt(city_name: str, api_key: str) -> bool:
         print(f'pdf soubor nebyl nalezen: {pdf_path}')
         return False
 
-    full_text = extract_text_from_pdf(pdf_path)
-    if not full_text:
-        print('Z pdf souboru nebyl extrahován žádný text.')
-        return False
-
-    chunks = split_text_into_chunks(full_text)
-    if not chunks:
-        print('Části textu nebyly vytvořeny.')
-        return False
-    summary_input = '\n'.join(chunks[:50])
+    sha256 = file_sha256(pdf_path)
+    summary = load_plan_result(sha256, 'summary', SUMMARY_MODEL, summary_prompt + SUMMARY_VARIANT)
+    METRICS.cache_lookup('plan_results', summary is not None)
+    if summary is None:
+        try:
+            chunks = iter_plan_chunks(pdf_path, sha256=sha256)
+            if RELEVANCE_FILTER:
+                chunks, report = relevant_chunks(pdf_path, sha256, SUMMARY_TOKEN_BUDGET, 'summary')
+                if report['chunks'] and not chunks:
+                    return False
+            else:
+                chunks = list(islice(chunks, SUMMARY_MAX_CHUNKS))
+            if not chunks:
+                print('Z pdf souboru nebyl extrahován žádný text.')
+                return False
+            summary_input = '\n'.join(chunks)
 
-    prompt = summary_prompt
-    prompt += f"\n'''\n{summary_input}\n'''"
-    summary = gpt_call(prompt, model=SUMMARY_MODEL, client=client)
+            prompt = summary_prompt
+            prompt += f"\n'''\n{summary_input}\n'''"
+            with METRICS.city(city_name):
+                summary = gpt_call(prompt, model=SUMMARY_MODEL, client=client)
+        except PlanReadError as e:
+            print(e)
+            return False
+        if summary:
+            save_plan_result(sha256, 'summary', SUMMARY_MODEL, summary_prompt + SUMMARY_VARIANT, summary)
 
     try:
         os.makedirs(folder, exist_ok=True)